@@ -3,9 +3,13 @@ import torch
 import math
 from torch.nn import functional as F
 import copy
+import functools
+import torch.utils.checkpoint
 from config import config
 from torch.autograd import Variable
 
+INSTRUMENTS = ["drums", "bass", "guitar", "strings"]  # order of the instruments in the first dimension
+
 
 class CompressiveEncoder(nn.Module):
     def __init__(self,
@@ -50,6 +54,8 @@ class CompressiveEncoder(nn.Module):
                 nn.init.xavier_uniform_(p)
 
     def forward(self, seq, mask, mems, cmems):
+        if config["model"]["fused_instruments"]:
+            return self.fused_forward(seq, mask, mems, cmems)
         d_z, d_mem, d_cmem, d_l, daw = self.drums_encoder(seq[0, ...], mask[0, ...], mems[0, ...],
                                                           cmems[0, ...], self.pos_emb[0, ...])
         b_z, b_mem, b_cmem, b_l, baw = self.bass_encoder(seq[1, ...], mask[1, ...], mems[1, ...],
@@ -63,9 +69,39 @@ class CompressiveEncoder(nn.Module):
         latents = torch.stack([d_z, b_z, g_z, s_z], dim=1)
         aux_loss = torch.stack((d_l, b_l, g_l, s_l)).mean()
         # aws = torch.mean(torch.stack([daw, baw, gaw, saw], dim=0), dim=0)
-        aws = torch.stack([daw, baw, gaw, saw], dim=0)
+        aws = stack_weights([daw, baw, gaw, saw], dim=0)
         return latents, mems, cmems, aux_loss, aws
 
+    def __getstate__(self):  # stacked parameters are not saved, they are stacked again when used
+        state = super(CompressiveEncoder, self).__getstate__()
+        state.pop("stacked_parameters", None)
+        return state
+
+    def fused_forward(self, seq, mask, mems, cmems):
+        """
+        Same as the four instrument encoders, but each operation runs once for all the instruments, with the
+        weights of the instruments stacked
+        """
+        encoders = Grouped([self.drums_encoder, self.bass_encoder, self.guitar_encoder, self.strings_encoder],
+                           stacked_parameters(self))
+        x = encoders.embedding(seq, "embed")
+        pos_emb = self.pos_emb[:, None]  # same for each element of the batch
+        new_mems, new_cmems, self_weights, attn_losses = [], [], [], []
+        for n_layer in range(self.drums_encoder.N):
+            layer = encoders.child("layers." + str(n_layer))
+            h = layer.layer_norm(x, "mem_attn.fn.norm")
+            h, new_mem, new_cmem, attn_loss, weights = layer.child("mem_attn.fn.fn").memory_attention(
+                h, mems[:, n_layer], cmems[:, n_layer], mask, pos_emb)
+            x = h + x
+            x = layer.child("feed_forward.fn.fn").feed_forward(layer.layer_norm(x, "feed_forward.fn.norm")) + x
+            new_mems.append(new_mem)
+            new_cmems.append(new_cmem)
+            self_weights.append(weights)
+            attn_losses.append(attn_loss)
+        aux_loss = torch.stack(attn_losses).sum() / self.drums_encoder.N
+        return (x.transpose(0, 1), torch.stack(new_mems, dim=1), torch.stack(new_cmems, dim=1), aux_loss,
+                stack_weights(self_weights, dim=1))
+
 
 class CompressiveDecoder(nn.Module):
     def __init__(self,
@@ -109,6 +145,8 @@ class CompressiveDecoder(nn.Module):
                 nn.init.xavier_uniform_(p)
 
     def forward(self, trg, trg_mask, src_mask, latent, d_mems, d_cmems, just=None, emb_weights=None):
+        if config["model"]["fused_instruments"]:
+            return self.fused_forward(trg, trg_mask, latent, d_mems, d_cmems, just=just, emb_weights=emb_weights)
         src_mask = None  # TODO fix architecture
         #  before each decoder received src_mask[0, ...] src_mask[1, ...] etc.
         if just is None:
@@ -146,8 +184,8 @@ class CompressiveDecoder(nn.Module):
             output = self.generator(output)
             aux_loss = torch.stack((d_loss, b_loss, g_loss, s_loss))
             aux_loss = torch.mean(aux_loss)
-            self_weights = torch.stack([d_self_w, b_self_w, g_self_w, s_self_w], dim=0)
-            src_weights = torch.stack([d_src_w, b_src_w, g_src_w, s_src_w])
+            self_weights = stack_weights([d_self_w, b_self_w, g_self_w, s_self_w], dim=0)
+            src_weights = stack_weights([d_src_w, b_src_w, g_src_w, s_src_w])
             return output, self_weights, src_weights, mems, cmems, aux_loss
         else:
             if just == "drums":
@@ -187,6 +225,84 @@ class CompressiveDecoder(nn.Module):
                 out = self.generator(out, just=just)
                 return out, None, None, None, None, None
 
+    def __getstate__(self):  # stacked parameters are not saved, they are stacked again when used
+        state = super(CompressiveDecoder, self).__getstate__()
+        state.pop("stacked_parameters", None)
+        return state
+
+    def fused_forward(self, trg, trg_mask, latent, d_mems, d_cmems, just=None, emb_weights=None):
+        """
+        Same as the four instrument decoders followed by the generator, but each operation runs once for all the
+        instruments, with the weights of the instruments stacked
+        :param just: name of the only instrument to decode, then trg, trg_mask and emb_weights are of that instrument
+        """
+        if just is None:
+            instruments = list(range(4))
+        else:  # same computation with only the instrument selected
+            instruments = [INSTRUMENTS.index(just)]
+            trg = trg[None]
+            trg_mask = trg_mask[None] if trg_mask is not None else None
+            emb_weights = emb_weights[None] if emb_weights is not None else None
+        decoders = [self.drums_decoder, self.bass_decoder, self.guitar_decoder, self.strings_decoder]
+        decoders = Grouped([decoders[i] for i in instruments], stacked_parameters(self))
+        x = decoders.embedding(trg, "embed", weights=emb_weights)
+        pos_emb = self.pos_emb[instruments, None]  # same for each element of the batch
+        latent = latent.reshape(latent.shape[0], -1, latent.shape[-1])  # a single latent is a sequence of length 1
+        latent = latent.expand((len(instruments),) + latent.shape)  # each instrument attends to the same latent
+        new_mems, new_cmems, self_weights, src_weights, attn_losses = [], [], [], [], []
+        for n_layer in range(self.drums_decoder.N):
+            layer = decoders.child("layers." + str(n_layer))
+            h = layer.layer_norm(x, "self_mem_attn.fn.norm")
+            h, new_mem, new_cmem, attn_loss, self_weight = layer.child("self_mem_attn.fn.fn").memory_attention(
+                h, d_mems[instruments, n_layer], d_cmems[instruments, n_layer], trg_mask, pos_emb)
+            x = h + x
+            h, src_weight = layer.child("src_attn.fn.fn").multi_headed_attention(
+                layer.layer_norm(x, "src_attn.fn.norm"), latent, latent)
+            x = h + x
+            x = layer.child("feed_forward.fn.fn").feed_forward(layer.layer_norm(x, "feed_forward.fn.norm")) + x
+            new_mems.append(new_mem)
+            new_cmems.append(new_cmem)
+            self_weights.append(self_weight)
+            src_weights.append(src_weight)
+            attn_losses.append(attn_loss)
+        output = self.generator(x, instruments=instruments, stacked=stacked_parameters(self))
+        if just is not None:
+            return output[0], None, None, None, None, None
+        aux_loss = torch.stack(attn_losses).sum() / self.drums_decoder.N
+        return (output, stack_weights(self_weights, dim=1), stack_weights(src_weights, dim=1),
+                torch.stack(new_mems, dim=1), torch.stack(new_cmems, dim=1), aux_loss)
+
+    def cache(self, latent, d_mems, d_cmems):
+        """
+        Starts the step-wise decoding of a bar
+        :return: cache of each instrument with keys and values of the memories and of the latent, without tokens
+        """
+        decoders = [self.drums_decoder, self.bass_decoder, self.guitar_decoder, self.strings_decoder]
+        return [decoder.cache(latent, mems, cmems) for decoder, mems, cmems in zip(decoders, d_mems, d_cmems)]
+
+    def step(self, trg, cache, length=config["model"]["seq_len"], emb_weights=None, just=None):
+        """
+        Decodes the next tokens of a bar reusing keys and values of the tokens already decoded, so that each token
+        costs time linear in the length of the bar. The outputs are the same as the ones of forward with the whole bar
+        :param trg: new tokens with shape (instruments, batch, tokens), they follow the ones in cache
+        :param cache: as returned by cache or step
+        :param length: length of the whole bar, relative positions are computed w.r.t. it
+        :param just: name of the only instrument to decode, then trg, cache and emb_weights are of that instrument
+        :return: output of the new tokens and cache with them
+        """
+        decoders = [self.drums_decoder, self.bass_decoder, self.guitar_decoder, self.strings_decoder]
+        if just is not None:
+            i = INSTRUMENTS.index(just)
+            out, cache = decoders[i].step(trg, cache, self.pos_emb[i], length, emb_weights=emb_weights)
+            return self.generator(out, just=just), cache
+        outputs, new_cache = [], []
+        for i, decoder in enumerate(decoders):
+            out, instrument_cache = decoder.step(trg[i], cache[i], self.pos_emb[i], length,
+                                                 emb_weights=emb_weights[i] if emb_weights is not None else None)
+            outputs.append(out)
+            new_cache.append(instrument_cache)
+        return self.generator(torch.stack(outputs, dim=0)), new_cache
+
 
 class Encoder(nn.Module):
     def __init__(self, layer, N, vocab_size, d_model):
@@ -210,7 +326,7 @@ class Encoder(nn.Module):
             new_cmems.append(new_cmem)
             attn_losses = attn_losses + attn_loss
         # self_weights = torch.mean(torch.stack(self_weights, dim=0), dim=
-        self_weights = torch.stack(self_weights, dim=0)
+        self_weights = stack_weights(self_weights, dim=0)
         new_mems = torch.stack(new_mems)
         new_cmems = torch.stack(new_cmems)
         attn_loss = attn_losses / self.N  # normalize w.r.t number of layers
@@ -227,17 +343,20 @@ class Decoder(nn.Module):
         self.pos = PositionalEncoding(d_model)
         self.N = N
 
+    def embed_tokens(self, trg, emb_weights=None):
+        if emb_weights is None:
+            return self.embed(trg)
+        # compute weighted sum of the embeddings
+        mix = torch.zeros((trg.shape[0], trg.shape[1], config["model"]["d_model"]), dtype=torch.float32,
+                          device=trg.device)
+        for i in range(trg.shape[-1]):
+            emb = self.embed(trg[..., i]) * emb_weights[..., i].unsqueeze(-1).expand_as(mix)
+            mix = mix + emb
+        return mix
+
     def forward(self, trg, trg_mask, src_mask, latent, mems, cmems, pos_emb, emb_weights=None):
         attn_losses = torch.tensor(0., requires_grad=True, device=trg.device, dtype=torch.float32)
-        if emb_weights is None:
-            trg = self.embed(trg)
-        else:  # compute weighted sum of the embeddings
-            mix = torch.zeros((trg.shape[0], trg.shape[1], config["model"]["d_model"]), dtype=torch.float32,
-                              device=trg.device)
-            for i in range(trg.shape[-1]):
-                emb = self.embed(trg[..., i]) * emb_weights[..., i].unsqueeze(-1).expand_as(mix)
-                mix = mix + emb
-            trg = mix
+        trg = self.embed_tokens(trg, emb_weights)
         # trg = self.pos(trg)
         new_mems = []
         new_cmems = []
@@ -253,13 +372,43 @@ class Decoder(nn.Module):
             attn_losses = attn_losses + attn_loss
         # src_weights = torch.mean(torch.stack(src_weights, dim=0), dim=(0, 1, 2))
         # self_weights = torch.mean(torch.stack(self_weights, dim=0), dim=(0, 1, 2))  # mn of layer batch instruments
-        src_weights = torch.stack(src_weights, dim=0)
-        self_weights = torch.stack(self_weights, dim=0)
+        src_weights = stack_weights(src_weights, dim=0)
+        self_weights = stack_weights(self_weights, dim=0)
         new_mems = torch.stack(new_mems)
         new_cmems = torch.stack(new_cmems)
         attn_losses = attn_losses / self.N  # normalize w.r.t number of layers
         return trg, self_weights, src_weights, new_mems, new_cmems, attn_losses
 
+    def cache(self, latent, mems, cmems):
+        """
+        :return: keys and values of memories and latent for each layer, and the tokens decoded, none for now
+        """
+        layers = [layer.cache(latent, (mem, cmem)) for layer, mem, cmem in zip(self.layers, mems, cmems)]
+        return {"layers": layers, "tokens": torch.zeros(latent.shape[0], 0, dtype=torch.bool, device=latent.device)}
+
+    def step(self, trg, cache, pos_emb, length, emb_weights=None):
+        """
+        :param trg: new tokens with shape (batch, tokens), emb_weights as in forward
+        :param length: length of the whole bar
+        :return: output of the new tokens and cache with them
+        """
+        line = trg[..., 0] if emb_weights is not None else trg
+        line = line != config["tokens"]["pad"]
+        tokens = torch.cat((cache["tokens"], line), dim=1)  # not pad tokens of the bar until now
+        n_new, n_tokens = line.shape[1], tokens.shape[1]
+        assert n_tokens <= length, 'the bar is longer than its length'
+        # same pad and causal mask of create_trg_mask for the rows of the new tokens
+        causal = torch.ones(n_new, n_tokens, dtype=torch.bool, device=trg.device).tril(n_tokens - n_new)
+        trg_mask = line[:, :, None] & tokens[:, None, :] & causal
+        # the shift in full_attn gives to the rows of the new tokens the positions they have in the whole bar
+        pos_emb = pos_emb[:, length - n_tokens:, :]
+        x = self.embed_tokens(trg, emb_weights)
+        layers = []
+        for layer, layer_cache in zip(self.layers, cache["layers"]):
+            x, layer_cache = layer.step(x, layer_cache, trg_mask, pos_emb)
+            layers.append(layer_cache)
+        return x, {"layers": layers, "tokens": tokens}
+
 
 class EncoderLayer(nn.Module):
     def __init__(self, mem_attn, feed_forward):
@@ -289,6 +438,23 @@ class DecoderLayer(nn.Module):
         x, = self.feed_forward(x)
         return x, new_mem, new_cmem, self_weights, src_weights, attn_loss
 
+    def cache(self, latent, memories):
+        src_attn = self.src_attn.fn.fn
+        return {"self": self.self_mem_attn.fn.fn.cache(memories),
+                "src": (src_attn.project(latent, 1), src_attn.project(latent, 2))}
+
+    def step(self, x, cache, trg_mask, pos_emb):
+        """
+        Same as forward for the new tokens x, with keys and values of memories, latent and previous tokens in cache
+        """
+        h = self.self_mem_attn.fn.norm(x)
+        h, _, self_cache = self.self_mem_attn.fn.fn.step(h, cache["self"], input_mask=trg_mask, pos_emb=pos_emb)
+        x = h + x
+        h, _ = self.src_attn.fn.fn.cached(self.src_attn.fn.norm(x), *cache["src"])
+        x = h + x
+        x, = self.feed_forward(x)
+        return x, {"self": self_cache, "src": cache["src"]}
+
 
 class MyMemoryAttention(nn.Module):
     def __init__(self, h, dim, seq_len, mem_len, cmem_len, cmem_ratio, attn_dropout=0.1,
@@ -309,14 +475,19 @@ class MyMemoryAttention(nn.Module):
 
     def forward(self, h, memories=None, input_mask=None, pos_emb=None):
         # Prepare mask
-        if input_mask is not None:
+        lengths, causal = None, False
+        if config["model"]["attention_chunk"]:  # lengths of the bars instead of the mask
+            lengths, causal = mask_lengths(input_mask, h.dim())
+            input_mask = None
+        elif input_mask is not None:
             if input_mask.dim() == 2:  # encoder mask, cover just pad
                 input_mask = input_mask[:, :, None] * input_mask[:, None, :]
             input_mask = F.pad(input_mask, (self.cmem_len + self.mem_len, 0), value=True)
         # Algorithm from paper
         m, cm = memories
         mem = torch.cat((cm, m, h), dim=1)  # TODO x too?
-        a, weights = self.multi_head_attention(h, key=mem, value=mem, mask=input_mask, pos_emb=pos_emb)
+        a, weights = self.multi_head_attention(h, key=mem, value=mem, mask=input_mask, pos_emb=pos_emb,
+                                               lengths=lengths, causal=causal)
         a = self.norm1(a + h)
         old_mem = m[:, :self.seq_len, :]
         new_cm = self.compress_mem_fn(old_mem)
@@ -343,6 +514,28 @@ class MyMemoryAttention(nn.Module):
 
         return h, m, cm, l_attn, weights
 
+    def cache(self, memories):
+        """
+        :return: keys and values of compressed memories and memories, as seen by the attention of forward
+        """
+        m, cm = memories
+        mem = torch.cat((cm, m), dim=1)
+        return self.multi_head_attention.project(mem, 1), self.multi_head_attention.project(mem, 2)
+
+    def step(self, h, cache, input_mask=None, pos_emb=None):
+        """
+        Attention of the new tokens h over memories and all the tokens until them, without updating memories
+        :param cache: keys and values of memories and previous tokens
+        :param input_mask: mask of h over all the tokens, memories excluded
+        :return: attention output, attention weights and cache with keys and values of h too
+        """
+        if input_mask is not None:
+            input_mask = F.pad(input_mask, (self.cmem_len + self.mem_len, 0), value=True)
+        keys = torch.cat((cache[0], self.multi_head_attention.project(h, 1)), dim=2)
+        values = torch.cat((cache[1], self.multi_head_attention.project(h, 2)), dim=2)
+        a, weights = self.multi_head_attention.cached(h, keys, values, mask=input_mask, pos_emb=pos_emb)
+        return self.norm1(a + h), weights, (keys, values)
+
 
 class MultiHeadedAttention(nn.Module):
     def __init__(self, h, d_model, dropout=0.1):
@@ -353,7 +546,10 @@ class MultiHeadedAttention(nn.Module):
         self.linears = (clones(nn.Linear(d_model, d_model, bias=False), 4))  # TODO bias or not?
         self.dropout = nn.Dropout(p=dropout)
 
-    def forward(self, query, key=None, value=None, mask=None, pos_emb=None):
+    def forward(self, query, key=None, value=None, mask=None, pos_emb=None, lengths=None, causal=False):
+        """
+        :param lengths: lengths and causal as in chunked_attn, used in place of mask if attention_chunk is set
+        """
         if mask is not None:  # apply same mask to all heads
             if mask.dim() == 2:
                 mask = mask[:, :, None] * mask[:, None, :]
@@ -361,7 +557,28 @@ class MultiHeadedAttention(nn.Module):
         n_batches = query.size(0)
         query, key, value = [l(x).view(n_batches, -1, self.h, self.d_out).transpose(1, 2)
                              for l, x in zip(self.linears, (query, key, value))]
-        x, weights = full_attn(query, key, value, mask=mask, dropout=self.dropout, pos_emb=pos_emb)
+        if config["model"]["attention_chunk"]:
+            x, weights = chunked_attn(query, key, value, lengths=lengths, causal=causal, dropout=self.dropout,
+                                      pos_emb=pos_emb, chunk_size=config["model"]["attention_chunk"])
+        else:
+            x, weights = full_attn(query, key, value, mask=mask, dropout=self.dropout, pos_emb=pos_emb)
+        x = x.transpose(1, 2).contiguous().view(n_batches, -1, self.h * self.d_out)
+        return self.linears[-1](x), weights
+
+    def project(self, x, n):
+        """
+        :return: x projected by the n-th linear layer, split in heads as in forward
+        """
+        return self.linears[n](x).view(x.size(0), -1, self.h, self.d_out).transpose(1, 2)
+
+    def cached(self, query, key, value, mask=None, pos_emb=None):
+        """
+        Same as forward, with key and value already projected
+        """
+        if mask is not None:  # apply same mask to all heads
+            mask = mask.unsqueeze(1)
+        n_batches = query.size(0)
+        x, weights = full_attn(self.project(query, 0), key, value, mask=mask, dropout=self.dropout, pos_emb=pos_emb)
         x = x.transpose(1, 2).contiguous().view(n_batches, -1, self.h * self.d_out)
         return self.linears[-1](x), weights
 
@@ -416,7 +633,16 @@ class Generator(nn.Module):
         self.proj_guitar = nn.Linear(d_model, vocab)
         self.proj_strings = nn.Linear(d_model, vocab)
 
-    def forward(self, x, just=None):
+    def forward(self, x, just=None, instruments=None, stacked=None):
+        """
+        :param instruments: if given, x has the instruments with these indices in the first dimension, and their
+        projections run as a single batched computation
+        :param stacked: as in Grouped
+        """
+        if instruments is not None:
+            projections = [self.proj_drums, self.proj_bass, self.proj_guitar, self.proj_strings]
+            projections = Grouped([projections[i] for i in instruments], stacked)
+            return F.log_softmax(projections.linear(x), dim=-1)
         if just is None:
             out_drums = F.log_softmax(self.proj_drums(x[0]), dim=-1)
             out_bass = F.log_softmax(self.proj_bass(x[1]), dim=-1)
@@ -460,16 +686,216 @@ class Embeddings(nn.Module):
         return aux * math.sqrt(self.d_model)
 
 
+class Grouped:
+    """
+    It runs modules with the same structure, one for each instrument, as a single batched computation: their
+    parameters are stacked on a new first dimension, inputs and outputs have the instrument as first dimension.
+    Parameters stay in the modules, so checkpoints and optimizers see the same layout
+    """
+
+    def __init__(self, modules, stacked=None):
+        """
+        :param stacked: dict where stacked parameters are kept until the parameters change, as returned by
+        stacked_parameters, so that they are stacked once for each optimizer step. None to stack them at each use
+        """
+        self.modules = modules
+        self.stacked = stacked
+
+    def child(self, name):
+        return Grouped([module.get_submodule(name) for module in self.modules], self.stacked)
+
+    def parameter(self, name):
+        parameters = [module.get_parameter(name) for module in self.modules]
+        if self.stacked is None:
+            return torch.stack(parameters)
+        key = (tuple(id(p) for p in parameters), torch.is_grad_enabled())
+        # optimizer steps and loads change the parameters in place, which increases their version
+        version = tuple((p._version, p.data_ptr()) for p in parameters)
+        if key not in self.stacked or self.stacked[key][0] != version:
+            self.stacked[key] = (version, torch.stack(parameters))
+        return self.stacked[key][1]
+
+    def broadcast(self, parameter, x):
+        """
+        :return: stacked parameter with shape (instruments, 1, ..., 1, -1) to be broadcast with x
+        """
+        return parameter.view((len(self.modules),) + (1,) * (x.dim() - 2) + parameter.shape[-1:])
+
+    def linear(self, x, name=""):
+        """
+        :param name: name of the linear layer in the modules, empty if the modules are the linear layers
+        """
+        linear = self.modules[0].get_submodule(name)
+        prefix = name + "." if name else ""
+        weight = self.parameter(prefix + "weight")
+        out = torch.matmul(x.reshape(len(self.modules), -1, x.shape[-1]), weight.transpose(1, 2))
+        out = out.view(x.shape[:-1] + (weight.shape[1],))
+        if linear.bias is not None:
+            out = out + self.broadcast(self.parameter(prefix + "bias"), out)
+        return out
+
+    def layer_norm(self, x, name):
+        norm = self.modules[0].get_submodule(name)
+        x = F.layer_norm(x, norm.normalized_shape, eps=norm.eps)
+        weight, bias = self.parameter(name + ".weight"), self.parameter(name + ".bias")
+        return x * self.broadcast(weight, x) + self.broadcast(bias, x)
+
+    def dropout(self, x, name):
+        dropout = self.modules[0].get_submodule(name)
+        return F.dropout(x, dropout.p, dropout.training)
+
+    def embedding(self, tokens, name, weights=None):
+        """
+        :param weights: if given, each position has the weighted sum of the embeddings of tokens in the last dimension
+        """
+        weight = self.parameter(name + ".weight")
+        instruments = torch.arange(len(self.modules), device=tokens.device).view((-1,) + (1,) * (tokens.dim() - 1))
+        if weights is None:
+            return weight[instruments, tokens]
+        return torch.einsum('n...k,n...kd->n...d', weights, weight[instruments, tokens])
+
+    def conv_compress(self, mem, name):
+        """
+        ConvCompress as a product of the windows of ratio memories with the kernel
+        """
+        weight = self.parameter(name + ".conv.weight")  # instruments, out, in, ratio
+        ratio = weight.shape[-1]
+        length = mem.shape[-2] // ratio
+        windows = mem[..., :length * ratio, :].reshape(mem.shape[:-2] + (length, ratio, mem.shape[-1]))
+        out = torch.einsum('n...tkc,nock->n...to', windows, weight)
+        return out + self.broadcast(self.parameter(name + ".conv.bias"), out)
+
+    def feed_forward(self, x):
+        x = self.linear(x, "w1")
+        x = F.gelu(x)
+        x = self.dropout(x, "dropout")
+        return self.linear(x, "w2")
+
+    def multi_headed_attention(self, query, key, value, mask=None, pos_emb=None, lengths=None, causal=False):
+        attention = self.modules[0]
+        if mask is not None:  # apply same mask to all heads
+            mask = mask.unsqueeze(-3)
+        query, key, value = [self.linear(x, "linears." + str(i)).view(x.shape[:-1] + (attention.h, attention.d_out))
+                             .transpose(-2, -3) for i, x in enumerate((query, key, value))]
+        if config["model"]["attention_chunk"]:
+            x, weights = chunked_attn(query, key, value, lengths=lengths, causal=causal, dropout=attention.dropout,
+                                      pos_emb=pos_emb, chunk_size=config["model"]["attention_chunk"])
+        else:
+            x, weights = full_attn(query, key, value, mask=mask, dropout=attention.dropout, pos_emb=pos_emb)
+        x = x.transpose(-2, -3).reshape(x.shape[:-3] + (x.shape[-2], attention.h * attention.d_out))
+        return self.linear(x, "linears.3"), weights
+
+    def memory_attention(self, h, m, cm, input_mask=None, pos_emb=None):
+        """
+        MyMemoryAttention of each instrument
+        """
+        attention = self.modules[0]
+        lengths, causal = None, False
+        if config["model"]["attention_chunk"]:  # lengths of the bars instead of the mask
+            lengths, causal = mask_lengths(input_mask, h.dim())
+            input_mask = None
+        elif input_mask is not None:
+            if input_mask.dim() == h.dim() - 1:  # encoder mask, cover just pad
+                input_mask = input_mask[..., :, None] * input_mask[..., None, :]
+            input_mask = F.pad(input_mask, (attention.cmem_len + attention.mem_len, 0), value=True)
+        mem = torch.cat((cm, m, h), dim=-2)
+        a, weights = self.child("multi_head_attention").multi_headed_attention(h, mem, mem, input_mask, pos_emb,
+                                                                               lengths=lengths, causal=causal)
+        a = self.layer_norm(a + h, "norm1")
+        old_mem = m[..., :attention.seq_len, :]
+        new_cm = self.conv_compress(old_mem, "compress_mem_fn")
+        m = torch.cat((m, h), dim=-2)[..., -attention.mem_len:, :]
+        cm = torch.cat((cm, new_cm), dim=-2)[..., -attention.cmem_len:, :]
+        # attention reconstruction
+        h_copy = a.detach().clone()
+        old_mem = torch.detach(old_mem)
+        Q, K, V = [self.parameter("multi_head_attention.linears." + str(i) + ".weight").detach()[:, None]
+                   for i in range(3)]
+
+        def attn(hh, mm):
+            hQ = torch.matmul(hh, Q).view(hh.shape[:-1] + (attention.h, attention.dim_head)).transpose(-2, -3)
+            mK = torch.matmul(mm, K).view(mm.shape[:-1] + (attention.h, attention.dim_head)).transpose(-2, -3)
+            mV = torch.matmul(mm, V).view(mm.shape[:-1] + (attention.h, attention.dim_head)).transpose(-2, -3)
+            reconstruction, _ = full_attn(hQ, mK, mV, dropout=attention.reconstruction_attn_dropout)
+            return reconstruction
+
+        new_cm = self.conv_compress(old_mem, "compress_mem_fn")
+        l_attn = F.mse_loss(attn(h_copy, old_mem), attn(h_copy, new_cm))
+        return a, m, cm, l_attn, weights
+
+
+def chunked_attn(q, k, v, lengths=None, causal=False, dropout=None, pos_emb=None, chunk_size=64):
+    """
+    Same as full_attn, with keys made of memories followed by the tokens of the queries. It computes chunk_size queries
+    at a time with masks made from lengths, so the attention matrix, the relative positions and the mask are never
+    materialized for all the queries. While training, each chunk is recomputed in the backward pass instead of being
+    kept in memory
+    :param lengths: not pad tokens at the beginning of each sequence, with the dimensions of q before the heads one.
+    None if all the tokens are valid
+    :param causal: each query attends only to the tokens until it, besides memories
+    :return: attention output and None in place of the attention weights
+    """
+    outs = []
+    for start in range(0, q.shape[-2], chunk_size):
+        args = (q[..., start:start + chunk_size, :], k, v, start, q.shape[-2], lengths, causal, dropout, pos_emb)
+        if torch.is_grad_enabled():
+            outs.append(torch.utils.checkpoint.checkpoint(attn_chunk, *args, use_reentrant=False))
+        else:
+            outs.append(attn_chunk(*args))
+    return torch.cat(outs, dim=-2), None
+
+
+def attn_chunk(q, k, v, start, n_queries, lengths, causal, dropout, pos_emb):
+    """
+    :param q: queries from start to start + q.shape[-2] of n_queries
+    :return: full_attn of the chunk of queries, with the rows of pos_emb and mask it needs
+    """
+    *_, i, dim = q.shape
+    j = k.shape[-2]
+    dots = torch.einsum('...id,...jd->...ij', q, k) * (dim ** -0.5)  # Q K^T
+    if pos_emb is not None:
+        # row r of full_attn uses the positional embeddings from n_queries - 1 - r, the chunk just the ones after its
+        # last row, which is the last row of its shifted matrix
+        first = n_queries - start - i
+        pos_dots = torch.einsum('...hid,...hjd->...hij', q, pos_emb[..., first:first + j + i - 1, :]) * (dim ** 0.5)
+        dots = dots + skew(pos_dots, j)
+    if lengths is not None or causal:
+        rows = torch.arange(start, start + i, device=q.device)[:, None]  # token of each query
+        cols = torch.arange(j, device=q.device)[None, :] - (j - n_queries)  # token of each key, < 0 for memories
+        visible = cols <= rows if causal else torch.ones_like(cols, dtype=torch.bool)
+        if lengths is not None:  # same for all heads
+            lengths = lengths[..., None, None, None]
+            visible = visible & (rows < lengths) & (cols < lengths)
+        dots = dots.masked_fill(~visible & (cols >= 0), -1e9)
+    attn = dots.softmax(dim=-1)
+    if dropout is not None:
+        attn = dropout(attn)
+    return torch.einsum('...ij,...jd->...id', attn, v)  # (Q K^T) V
+
+
+def mask_lengths(input_mask, dim):
+    """
+    :param input_mask: pad mask of the encoder or pad and causal mask of the decoder, pads only at the end of the bars
+    :param dim: dimensions of the input of the attention, the mask of the encoder has one less
+    :return: lengths of the bars and if the mask is causal, as needed by chunked_attn
+    """
+    if input_mask is None:
+        return None, False
+    causal = input_mask.dim() == dim
+    line = input_mask.diagonal(dim1=-2, dim2=-1) if causal else input_mask
+    positions = torch.arange(1, line.shape[-1] + 1, device=line.device)
+    return (line * positions).amax(dim=-1), causal
+
+
 def full_attn(q, k, v, mask=None, dropout=None, pos_emb=None):
     *_, dim = q.shape
-    dots = torch.einsum('bhid,bhjd->bhij', q, k) * (dim ** -0.5)  # Q K^T
+    dots = torch.einsum('...id,...jd->...ij', q, k) * (dim ** -0.5)  # Q K^T
 
     if pos_emb is not None:
         # pos_emb = pos_emb[:, -(k.shape[-2] + v.shape[-2]):].type(q.dtype) TODO add if use lucidrains memattn
         # pos_dots = torch.einsum('bhid,hjd->bhij', q, pos_emb) * (q.shape[-1] ** 0.5)  TODO remove we have dim
-        pos_dots = torch.einsum('bhid,hjd->bhij', q, pos_emb) * (dim ** 0.5)
-        pos_dots = shift(pos_dots)  # left upper triangular has positional embedding of illegal token
-        pos_dots = pos_dots[..., :dots.shape[-1]]  # TODO select useful embedding, confirm or remove
+        pos_dots = torch.einsum('...hid,...hjd->...hij', q, pos_emb) * (dim ** 0.5)
+        pos_dots = skew(pos_dots, dots.shape[-1])  # left upper triangular has positional embedding of illegal token
         dots = dots + pos_dots
 
     if mask is not None:
@@ -477,7 +903,24 @@ def full_attn(q, k, v, mask=None, dropout=None, pos_emb=None):
     attn = dots.softmax(dim=-1)
     if dropout is not None:
         attn = dropout(attn)
-    return torch.einsum('bhij,bhjd->bhid', attn, v), attn  # (Q K^T) V
+    return torch.einsum('...ij,...jd->...id', attn, v), attn  # (Q K^T) V
+
+
+def stacked_parameters(module):
+    """
+    :return: dict for the stacked parameters of the fused forward of module, out of the state of module, so that
+    checkpoints are the same with and without it
+    """
+    return module.__dict__.setdefault("stacked_parameters", {})
+
+
+def stack_weights(weights, dim=0):
+    """
+    :return: attention weights stacked, None if the attention does not give them
+    """
+    if weights[0] is None:
+        return None
+    return torch.stack(weights, dim=dim)
 
 
 def clones(module, N):
@@ -518,6 +961,32 @@ def shift(x):
     return shifted[..., :i, i - 1:]
 
 
+def skew(x, width):
+    """
+    Same as shift(x)[..., :width], without building padded copies of x: row r of the result is row r of x from
+    column i - 1 - r, with zeros after the end of the row. When no row goes past its end, it is a strided view of x
+    where each row starts one element before the end of the previous one, otherwise a gather with an index cached
+    for the shape
+    """
+    *_, i, j = x.shape
+    if width + i - 2 < j:
+        if x.stride(-1) != 1 or x.stride(-2) != j:
+            x = x.contiguous()
+        return x.as_strided(x.shape[:-1] + (width,), x.stride()[:-2] + (j - 1, 1), x.storage_offset() + i - 1)
+    index, after = skew_index(i, width, j, x.device)
+    return x.gather(-1, index.expand(x.shape[:-1] + (width,))).masked_fill(after, 0.)
+
+
+@functools.lru_cache(maxsize=64)  # shapes change with bar widths, decoding steps and chunks, keep just the recent ones
+def skew_index(i, width, j, device):
+    """
+    :return: column of x of each element of skew(x, width), for x with shape (..., i, j), and mask of the ones after
+    the end of their row, whose index is clamped
+    """
+    index = torch.arange(width, device=device)[None, :] + (i - 1) - torch.arange(i, device=device)[:, None]
+    return index.clamp(max=j - 1), index >= j
+
+
 def to(t):
     return {'dtype': t.dtype, 'device': t.device}
 
@@ -15,11 +15,19 @@ config = {
         "do_eval": False,
         "aae": False,
         "n_bars": 8 if remote else 8,  # TODO careful
+        "window_stride": None,  # bars between the start of two windows of a song, None for data truncated_bars
+        "loader_masks": False,  # loader gives also trg and masks, otherwise only src and the rest is built on device
+        "contiguous_songs": False,  # windows of a song in order, memories carried from a window to the next one
+        "cache_size": 0,  # bytes of decoded windows kept in memory, shared ones in /dev/shm, 0 to disable the cache
+        "cache_shared": True,  # cache in shared memory, used and filled by all the loader workers
         "test_losses": False,
         "device": "cuda" if remote else "cuda",
         "batch_size": 1 if remote else 1,
         "test_size": 0.00001 if remote else 0.1,  # 0.001 if remote else 0.1,  # 100 on remote  it was 0.0001 in remote
+        "split_seed": 0,  # the split of raw songs between training and test set depends only on this
         "n_workers": 0,
+        "prefetch_factor": 4,  # batches loaded in advance by each loader worker
+        "pin_memory": True,  # batches in page-locked memory, so that copies to the gpu are asynchronous
         "n_epochs": 25000,
         "label_smoothing": 0.1,
         "steps_before_eval": 1000 if remote else 500,  # if >= early_stopping, happens at each epoch
@@ -41,6 +49,10 @@ config = {
         "interpolation_timesteps": 3,  # intermediate timesteps excluding first and second (with 3: 0 (1 2 3) 4)
         "interpolation_timesteps_length": 4,  # number of bar for each timesteps
         "top_k_mixed_embeddings": 5,
+        # decode with cached keys and values, positions of each token are the ones it has in the whole bar, as in the
+        # teacher forced pass. Off: recompute the growing prefix at each token as before, slower.
+        # Outputs differ (README)
+        "step_decoding": False,
         "min_tf_prob": 0.,
         "max_tf_prob": 1.,
         "tf_prob_step_reduction": 5e-4 if remote else 1e-3  # 5e-4 seems good
@@ -58,15 +70,24 @@ config = {
         "attn_layer_dropout": 0.1,
         "ff_dropout": 0.1,
         "discriminator_dropout": 0.1,
-        "n_latents": 200
+        "n_latents": 200,
+        "fused_instruments": True,  # run the four instruments at once with stacked weights, instead of one at a time
+        "attention_chunk": 0  # queries per chunk of the memory efficient attention, 0 for the full attention matrix
     },
     "data": {  # Parameters to create and listen the note representation
-        "truncated_bars": 32 if remote else 8,  # To truncate the song along bars
+        "truncated_bars": 32 if remote else 8,  # windows take the first n_bars of each run of truncated_bars bars
         "max_bar_length": max_bar_length,
         "max_bars": 200,
         "use_velocity": False,
         "reconstruction_programs": [0, 0, 32, 40],
-        "early_stop": 100000 if remote else 10,  # set this to 0 to disable early stop
+        "early_stop": 100000 if remote else 10,  # songs to store, set this to 0 to disable early stop
+        "n_workers": os.cpu_count() if remote else 1,  # processes converting songs, 1 converts in the main one
+        "chunk_size": 16,  # songs given to a conversion process at once
+        "tokens_per_shard": 1 << 24,  # tokens stored in each binary file of the dataset, without bar padding
+        "compact_threshold": 0.5,  # shards with a larger fraction of tokens of dropped songs are rewritten
+        "checkpoint_every": 1000,  # songs converted between two saves of the manifest, to resume conversion
+        "deduplicate": True,  # skip songs with the same windows of a song already converted
+        "duplicate_threshold": 0.8,  # estimated jaccard similarity of the bars of two near duplicate songs
         "resolution": 24,
         "tempo": 120,
         "velocities_total": (0, 127),  # using min max scaling, limits are inclusive
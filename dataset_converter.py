@@ -0,0 +1,344 @@
+import muspy
+import os
+import io
+import sys
+import multiprocessing
+import numpy as np
+from tqdm.auto import tqdm
+from config import config
+import time
+from dataset_storage import ShardWriter, Manifest, file_hash
+from midi_catalog import MidiCatalog
+from dataset_stats import ConversionStats
+from dataset_dedup import fingerprint, DuplicateIndex
+
+
+_worker = None  # converter instance of a worker process
+
+
+def _init_worker(converter_class):
+    global _worker
+    _worker = converter_class()
+
+
+def _convert_file(job):
+    return _worker.convert_file(job)
+
+
+class DatasetConverter:
+    """
+    Base class of the representation managers: it filters the raw songs and drives the conversion of the
+    whole dataset, spreading the songs over config["data"]["n_workers"] processes.
+    Subclasses implement transform_song, that turns a filtered song into a (4, bars, tokens) array
+    """
+    representation = None  # name of the token representation, part of the preprocessing config
+
+    def __init__(self):
+        self.log = None
+        self.log_file = "dataset_converter_log.txt"
+        self.count = 0  # number of samples written
+        self.song_index = 0  # index of the song being converted, used in logs
+        self.stats = ConversionStats()  # bar and song lengths
+        self.pad = config["tokens"]["pad"]
+        self.resolution = config["data"]["resolution"]
+
+    def filter_song(self, s):
+        """
+        :param s: Muspy song
+        :return: filtered song or None if s is invalid
+        """
+        for t in s.time_signatures:  # check time signature
+            if t.numerator != 4 or t.denominator != 4:
+                self.log.write(str(self.song_index) + ": Song with weird time skipped: {} / {}\n".
+                               format(t.numerator, t.denominator))
+                return None
+        old_stdout = sys.stdout  # backup current stdout because adjust_resolution is too verbose
+        sys.stdout = open(os.devnull, "w")
+        try:
+            s.adjust_resolution(self.resolution)  # computationally heavy
+            s.clip()  # clip velocities into 0-127
+        finally:  # stdout is restored also if the song is invalid
+            sys.stdout.close()
+            sys.stdout = old_stdout
+        drum = None
+        guitar = None
+        bass = None
+        strings = None
+        for track in s.tracks:
+            if track.is_drum:  # is a drum
+                if drum is None or len(track.notes) > len(drum.notes):  # and is better than the others
+                    drum = track
+            elif 0 <= track.program <= 31:
+                if guitar is None or len(track.notes) > len(guitar.notes):
+                    guitar = track
+            elif 32 <= track.program <= 39:
+                if bass is None or len(track.notes) > len(bass.notes):
+                    bass = track
+            elif strings is None or len(track.notes) > len(strings.notes):
+                strings = track
+        if drum is None or guitar is None or bass is None or strings is None:
+            return None
+        new = muspy.Music(tempos=[muspy.Tempo(time=0, qpm=120)],  # default tempo
+                          time_signatures=[muspy.TimeSignature(time=0, numerator=4, denominator=4)],
+                          resolution=self.resolution,  # default resolution
+                          )
+        new.tracks = [drum, guitar, bass, strings]
+        return new
+
+    @staticmethod
+    def may_pass_filter(midi):
+        """
+        Same checks of filter_song on the metadata of the raw file, so that songs are skipped before being read
+        :param midi: metadata of the raw song as returned by midi_catalog.scan_midi, None if unknown
+        :return: False if muspy cannot read the song or filter_song would reject it
+        """
+        if midi is None:
+            return True
+        if not midi["readable"] or midi["type"] == 2 or midi["ticks"] < 1:  # muspy raises an error
+            return False
+        for numerator, denominator in midi["time_signatures"]:
+            if numerator != 4 or denominator != 4:
+                return False
+        found = set()
+        for program, is_drum, _ in midi["tracks"]:
+            if is_drum:
+                found.add("drum")
+            elif 0 <= program <= 31:
+                found.add("guitar")
+            elif 32 <= program <= 39:
+                found.add("bass")
+            else:
+                found.add("strings")
+        return len(found) == 4
+
+    def transform_song(self, s):
+        """
+        :param s: filtered Muspy song
+        :return: array with shape (4, bars, tokens) or None if invalid
+        """
+        raise NotImplementedError
+
+    def is_silent(self, bar):
+        """
+        :param bar: array with shape (4, tokens)
+        :return: True if no instrument except drums plays in the bar
+        """
+        return (bar[1:, :] == self.pad).all()
+
+    def trim_song(self, tensor_song):
+        """
+        The song is stored once, training windows of any length are taken from it when it is loaded
+        :param tensor_song: array with shape (4, bars, tokens)
+        :return: array with shape (4, bars, tokens), from the first bar that is not silent to the first empty bar
+        excluded, or None if no bar is left
+        """
+        # invert bars and instrument to skip some bar
+        tensor_song = np.swapaxes(tensor_song, 0, 1)
+        # skip empty bars at the beginning or with just drums (stick for tempos)
+        while len(tensor_song) > 0 and self.is_silent(tensor_song[0]):
+            tensor_song = tensor_song[1:, ...]
+        # a window never contains an empty bar
+        empty = np.flatnonzero((tensor_song == self.pad).all(axis=(1, 2)))
+        if len(empty) > 0:
+            tensor_song = tensor_song[:empty[0]]
+        if len(tensor_song) == 0:
+            return None
+        return np.swapaxes(tensor_song, 0, 1)  # invert again bars and instruments
+
+    def convert_file(self, job):
+        """
+        Converts a single raw song, it is executed by the worker processes. Errors are logged and give no song
+        :param job: tuple (song index, file path)
+        :return: trimmed song or None, hash of the file, log lines, statistics and fingerprint of the song
+        """
+        self.song_index, filepath = job
+        self.log = io.StringIO()
+        self.stats = ConversionStats()
+        trimmed_song = None
+        content_hash = None
+        song_fingerprint = None
+        try:
+            content_hash = file_hash(filepath)
+            song = muspy.read(filepath)
+        except Exception as e:  # invalid song format
+            self.log.write(str(self.song_index) + ": Invalid song format: " + e.__str__() + '\n')
+            return None, content_hash, self.log.getvalue(), self.stats, None
+        try:
+            filtered_song = self.filter_song(song)
+            if filtered_song is not None:  # if the song has 4 valid tracks
+                tensor_song = self.transform_song(filtered_song)
+                if tensor_song is not None:
+                    trimmed_song = self.trim_song(tensor_song)
+            song_fingerprint = fingerprint(trimmed_song)
+        except Exception as e:  # a song that breaks the conversion is skipped, not the whole conversion
+            self.log.write(str(self.song_index) + ": Conversion failed: " + type(e).__name__ + ": " + e.__str__() +
+                           '\n')
+            trimmed_song, song_fingerprint = None, None
+            self.stats = ConversionStats()  # the statistics of the song may be partial
+        return trimmed_song, content_hash, self.log.getvalue(), self.stats, song_fingerprint
+
+    def preprocessing_config(self):
+        """
+        :return: parameters the stored song depends on
+        """
+        return {"representation": self.representation,
+                "resolution": self.resolution,
+                "max_bar_length": config["data"]["max_bar_length"],
+                "max_bars": config["data"]["max_bars"],
+                "use_velocity": config["data"]["use_velocity"],
+                "duplicate_threshold": config["data"]["duplicate_threshold"] if config["data"]["deduplicate"] else None}
+
+    @staticmethod
+    def list_songs(raw_midi):
+        """
+        Walks the raw dataset in sorted order, so that sample ids do not depend on the file system
+        """
+        for subdir, dirs, files in os.walk(raw_midi):
+            dirs.sort()
+            for filename in sorted(files):
+                yield os.path.join(subdir, filename)
+
+    def convert_dataset(self):
+        """
+        Given a dataset path and a destination path, it walks all directories of dataset
+        and for each song create a tensor.
+        Songs already converted with the same content and config are skipped, so an interrupted or
+        outdated conversion is resumed: stored songs of changed or removed raw songs are dropped, and their
+        duplicates are converted again
+        """
+        # download raw dataset if needed
+        if not os.path.exists(os.path.join(config["paths"]["raw_midi"], "lmd_matched")):
+            print("Downloading Lakh Dataset into " + config["paths"]["raw_midi"])
+            muspy.LakhMIDIMatchedDataset(config["paths"]["raw_midi"], download_and_extract=True)
+        print("Converting Lakh Dataset from " + config["paths"]["raw_midi"] + " in " + config["paths"]["dataset"])
+        raw_midi = config["paths"]["raw_midi"] + os.sep + "lmd_matched"
+        os.makedirs(config["paths"]["dataset"], exist_ok=True)
+        writer = ShardWriter(config["paths"]["dataset"], 4, config["data"]["max_bar_length"], self.pad,
+                             tokens_per_shard=config["data"]["tokens_per_shard"])
+        manifest = Manifest(config["paths"]["dataset"])
+        song_stats = {}  # song name -> counts of its statistics, to rebuild them without dropped songs on resume
+        if not writer.resumed:
+            manifest.clear()
+        else:
+            song_stats = ConversionStats.load_songs(config["paths"]["dataset"])
+            if song_stats is None:
+                print("No statistics of the songs already converted, they only count the songs converted now.")
+                song_stats = {}
+        digest = manifest.add_config(self.preprocessing_config())
+        # drop songs written after the last checkpoint of an interrupted conversion
+        writer.drop(set(writer.live()) - manifest.samples())
+        # find songs to convert and drop samples of changed or removed songs
+        print("Looking for new or changed songs...")
+        jobs = []
+        walked = {}  # name -> (song_index, filepath) of each raw song
+        dropped = set()
+        for song_index, filepath in enumerate(self.list_songs(raw_midi)):
+            name = os.path.relpath(filepath, raw_midi)
+            walked[name] = (song_index, filepath)
+            if manifest.is_converted(name, filepath, digest):
+                continue
+            if name in manifest.songs:
+                writer.drop(manifest.remove(name))
+                dropped.add(name)
+            jobs.append((song_index, filepath))
+        for name in set(manifest.songs) - set(walked):
+            writer.drop(manifest.remove(name))
+            dropped.add(name)
+        # duplicates of dropped songs are converted again, one of them may be the original now
+        requeued = [name for name, entry in manifest.songs.items() if entry.get("duplicate_of") in dropped]
+        for name in requeued:
+            writer.drop(manifest.remove(name))
+            jobs.append(walked[name])
+        # statistics of the songs kept, the ones of dropped songs are left out and converted songs add theirs again
+        song_stats = {name: counts for name, counts in song_stats.items() if name in manifest.songs}
+        for counts in song_stats.values():
+            self.stats.merge(ConversionStats.from_counts(counts))
+        jobs.sort()
+        # skip songs that surely do not pass filter_song, looking only at their metadata
+        catalog = MidiCatalog(config["paths"]["raw_midi"])
+        print("Scanned", catalog.update([(os.path.relpath(filepath, raw_midi), filepath) for _, filepath in jobs],
+                                        config["data"]["n_workers"], config["data"]["chunk_size"]),
+              "songs for the catalog.")
+        catalog.save()
+        skipped = [job for job in jobs if not self.may_pass_filter(catalog.get(os.path.relpath(job[1], raw_midi)))]
+        jobs = [job for job in jobs if self.may_pass_filter(catalog.get(os.path.relpath(job[1], raw_midi)))]
+        self.count = len(writer.live())
+        print("Found", len(jobs), "songs to convert,", len(requeued), "of them duplicates of changed songs,",
+              len(skipped), "skipped by the catalog,", self.count, "songs already in the dataset.")
+        early_stop = config["data"]["early_stop"]
+        if early_stop != 0 and self.count >= early_stop:
+            jobs = []
+        time.sleep(1.)  # sleep one second for a correct output presentation
+        progbar = tqdm(total=len(jobs) if early_stop == 0 else early_stop, initial=0 if early_stop == 0 else
+                       min(self.count, early_stop), leave=True, position=0, desc="Dataset creation")
+        # songs already in the dataset are the originals of the duplicates
+        deduplicate = config["data"]["deduplicate"]
+        duplicates = DuplicateIndex(threshold=config["data"]["duplicate_threshold"])
+        for name, entry in manifest.songs.items():
+            if entry.get("fingerprint") is not None:
+                duplicates.add(name, entry["fingerprint"])
+        n_exact, n_near = 0, 0
+        # setting up log file
+        self.log = open(self.log_file, "w")
+        self.log.write("Log of dataset_converter, to check if it is working right\n")
+        for song_index, filepath in skipped:  # recorded as converted songs without samples
+            self.log.write(str(song_index) + ": Song skipped by catalog\n")
+            name = os.path.relpath(filepath, raw_midi)
+            manifest.add(name, filepath, catalog.hash(name), digest, [])  # hash of the catalog scan, just done
+        # main loop: workers convert songs, results are written here in the order of the walk
+        n_workers = config["data"]["n_workers"]
+        pool = None
+        if n_workers > 1:
+            pool = multiprocessing.Pool(n_workers, initializer=_init_worker, initargs=(type(self),))
+            results = pool.imap(_convert_file, jobs, chunksize=config["data"]["chunk_size"])
+        else:
+            results = map(type(self)().convert_file, jobs)
+        try:
+            for n, ((song_index, filepath), (trimmed_song, content_hash, log, stats, song_fingerprint)) in \
+                    enumerate(zip(jobs, results)):
+                self.log.write(log)
+                self.stats.merge(stats)
+                name = os.path.relpath(filepath, raw_midi)
+                if stats.to_counts() is not None:
+                    song_stats[name] = stats.to_counts()
+                original = None
+                if deduplicate and song_fingerprint is not None:
+                    duplicate = duplicates.find(song_fingerprint)
+                    if duplicate is not None:  # recorded as a converted song without samples
+                        original, exact = duplicate
+                        n_exact, n_near = n_exact + exact, n_near + (not exact)
+                        self.log.write(str(song_index) + ": " + ("Exact" if exact else "Near") + " duplicate of " +
+                                       original + " skipped\n")
+                        trimmed_song, song_fingerprint = None, None
+                    else:
+                        duplicates.add(name, song_fingerprint)
+                if early_stop == 0:  # if not early stop, update bar for each song
+                    progbar.update()
+                samples = []
+                if trimmed_song is not None:
+                    samples.append(writer.append(trimmed_song))
+                    self.count += 1
+                    # if early stop, update bar only after a success
+                    if early_stop != 0:
+                        progbar.update()
+                manifest.add(name, filepath, content_hash, digest, samples, song_fingerprint, duplicate_of=original)
+                if early_stop != 0 and self.count >= early_stop:
+                    break
+                if (n + 1) % config["data"]["checkpoint_every"] == 0:  # a crash will resume from here
+                    writer.flush()
+                    ConversionStats.save_songs(config["paths"]["dataset"], song_stats)  # before the manifest
+                    manifest.save()
+        finally:
+            if pool is not None:
+                pool.terminate()
+            writer.close()
+            ConversionStats.save_songs(config["paths"]["dataset"], song_stats)
+            manifest.save()
+        print("Compacted", writer.compact(config["data"]["compact_threshold"]), "shards with dropped songs.")
+        self.log.write("Skipped " + str(n_exact) + " exact and " + str(n_near) + " near duplicate songs\n")
+        print("Skipped", n_exact, "exact and", n_near, "near duplicate songs.")
+        print("Song converted, saving statistics and plotting histograms...")
+        self.stats.save(config["paths"]["dataset"])
+        ConversionStats.plot(config["paths"]["dataset"])
+        self.log.close()
+        progbar.close()
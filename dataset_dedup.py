@@ -0,0 +1,74 @@
+import base64
+import hashlib
+import numpy as np
+from dataset_storage import mix64
+
+
+N_HASHES = 64  # length of the MinHash signature
+_SEEDS = np.random.default_rng(0).integers(0, 2 ** 63, N_HASHES, dtype=np.int64).astype(np.uint64)
+
+
+def fingerprint(song):
+    """
+    Exact and near-duplicate fingerprint of a song. The near-duplicate one is a MinHash signature of the pairs of
+    consecutive bars of each instrument, so that songs with most bars in common, also shifted or with some bar
+    changed, have similar signatures
+    :param song: array with shape (4, bars, tokens) or None
+    :return: tuple (hash of the song, MinHash signature as base64) or None if there is no song
+    """
+    if song is None:
+        return None
+    song = np.ascontiguousarray(song)
+    exact = hashlib.sha1(song.tobytes()).hexdigest()
+    with np.errstate(over="ignore"):
+        # hash of each bar of each instrument, then of each pair of consecutive bars
+        weights = mix64(np.arange(1, song.shape[2] + 1, dtype=np.uint64))
+        bars = mix64((song.astype(np.int64).astype(np.uint64) * weights).sum(axis=2, dtype=np.uint64))
+        bars += mix64(np.arange(len(song), dtype=np.uint64))[:, None]  # same bars of different instruments differ
+        shingles = mix64(bars[:, :-1] * np.uint64(0x9E3779B97F4A7C15) + bars[:, 1:]) if song.shape[1] > 1 else bars
+        signature = mix64(shingles.reshape(1, -1) ^ _SEEDS[:, None]).min(axis=1) >> np.uint64(32)
+    return exact, base64.b64encode(signature.astype("<u4").tobytes()).decode()
+
+
+def decode_signature(signature):
+    return np.frombuffer(base64.b64decode(signature), dtype="<u4")
+
+
+class DuplicateIndex:
+    """
+    Fingerprints of the songs kept so far. A song is an exact duplicate if its hash is known, a near
+    duplicate if the estimated Jaccard similarity of its bars with a kept song reaches threshold: candidates are
+    found with locality sensitive hashing on bands of the signature
+    """
+
+    def __init__(self, threshold=0.8, bands=16):
+        self.threshold = threshold
+        self.bands = bands
+        self.exact = {}  # song hash -> song name
+        self.buckets = {}  # (band, band values) -> song names
+        self.signatures = {}  # song name -> signature
+
+    def find(self, song_fingerprint):
+        """
+        :param song_fingerprint: fingerprint of a song as returned by fingerprint
+        :return: tuple (kept song, True if exact duplicate) or None if the song is not a duplicate
+        """
+        exact, signature = song_fingerprint
+        if exact in self.exact:
+            return self.exact[exact], True
+        signature = decode_signature(signature)
+        candidates = set()
+        for band, values in enumerate(np.split(signature, self.bands)):
+            candidates.update(self.buckets.get((band, values.tobytes()), ()))
+        for name in sorted(candidates):
+            if np.mean(self.signatures[name] == signature) >= self.threshold:
+                return name, False
+        return None
+
+    def add(self, name, song_fingerprint):
+        exact, signature = song_fingerprint
+        signature = decode_signature(signature)
+        self.exact[exact] = name
+        self.signatures[name] = signature
+        for band, values in enumerate(np.split(signature, self.bands)):
+            self.buckets.setdefault((band, values.tobytes()), []).append(name)
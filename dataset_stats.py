@@ -0,0 +1,212 @@
+import os
+import json
+import numpy as np
+import matplotlib.pyplot as plt
+from config import config
+from dataset_storage import replace_file
+
+
+STATISTICS_FILE = "statistics.json"
+SONG_STATISTICS_FILE = "song_statistics.json"  # values of each song, to rebuild the statistics on resume
+INSTRUMENTS = ["drums", "guitar", "bass", "strings"]  # order of the tracks given by filter_song
+
+
+class StreamingStats:
+    """
+    Statistics of a stream of non-negative integers in constant memory: count, min, max, mean, a histogram with
+    fixed bins over [0, upper), whose last bin counts the values over the range, and a quantile sketch with
+    logarithmic buckets, so that quantiles have a bounded relative error. Statistics of many processes are merged
+    """
+
+    def __init__(self, upper, n_bins=100, relative_error=0.01):
+        self.upper = upper
+        self.n_bins = n_bins
+        self.relative_error = relative_error
+        self.gamma = (1 + relative_error) / (1 - relative_error)
+        self.count = 0
+        self.total = 0
+        self.minimum = None
+        self.maximum = None
+        self.histogram = np.zeros(n_bins + 1, dtype=np.int64)
+        self.sketch = {}  # bucket i counts values in (gamma^(i-1), gamma^i], bucket -1 counts zeros
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.int64).ravel()
+        if len(values) == 0:
+            return
+        self.count += len(values)
+        self.total += int(values.sum())
+        self.minimum = int(values.min()) if self.minimum is None else min(self.minimum, int(values.min()))
+        self.maximum = int(values.max()) if self.maximum is None else max(self.maximum, int(values.max()))
+        self.histogram += np.bincount(np.minimum(values * self.n_bins // self.upper, self.n_bins),
+                                      minlength=self.n_bins + 1)
+        buckets = np.where(values > 0, np.ceil(np.log(np.maximum(values, 1)) / np.log(self.gamma) - 1e-9), -1)
+        for bucket, count in zip(*np.unique(buckets.astype(np.int64), return_counts=True)):
+            self.sketch[int(bucket)] = self.sketch.get(int(bucket), 0) + int(count)
+
+    def merge(self, other):
+        assert (self.upper, self.n_bins, self.relative_error) == (other.upper, other.n_bins, other.relative_error)
+        if other.count == 0:
+            return
+        self.count += other.count
+        self.total += other.total
+        self.minimum = other.minimum if self.minimum is None else min(self.minimum, other.minimum)
+        self.maximum = other.maximum if self.maximum is None else max(self.maximum, other.maximum)
+        self.histogram += other.histogram
+        for bucket, count in other.sketch.items():
+            self.sketch[bucket] = self.sketch.get(bucket, 0) + count
+
+    def quantile(self, q):
+        """
+        :return: value with rank q * (count - 1), with relative error at most relative_error
+        """
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for bucket in sorted(self.sketch):
+            seen += self.sketch[bucket]
+            if seen > rank:
+                value = 0. if bucket < 0 else 2 * self.gamma ** bucket / (self.gamma + 1)
+                return min(max(value, self.minimum), self.maximum)
+        return float(self.maximum)
+
+    def to_dict(self):
+        return {"count": self.count, "min": self.minimum, "max": self.maximum,
+                "mean": self.total / self.count if self.count > 0 else None,
+                "quantiles": {str(q): self.quantile(q) for q in (0.01, 0.1, 0.25, 0.5, 0.75, 0.9, 0.99)},
+                "total": self.total, "upper": self.upper, "histogram": self.histogram.tolist(),
+                "relative_error": self.relative_error, "sketch": {str(k): v for k, v in sorted(self.sketch.items())}}
+
+    @classmethod
+    def from_dict(cls, d):
+        stats = cls(d["upper"], n_bins=len(d["histogram"]) - 1, relative_error=d["relative_error"])
+        stats.count, stats.total, stats.minimum, stats.maximum = d["count"], d["total"], d["min"], d["max"]
+        stats.histogram = np.array(d["histogram"], dtype=np.int64)
+        stats.sketch = {int(k): v for k, v in d["sketch"].items()}
+        return stats
+
+
+class ConversionStats:
+    """
+    Bar lengths (tokens of a bar before truncation) and song lengths (bars) of each instrument, collected by the
+    converters: each process collects its own and the main one merges them. The values are also counted, so that
+    the statistics of a song are saved in little space and merged again when the conversion is resumed
+    """
+
+    def __init__(self):
+        self.stats = {"bar_length": [StreamingStats(2 * config["data"]["max_bar_length"]) for _ in INSTRUMENTS],
+                      "song_length": [StreamingStats(2 * config["data"]["max_bars"]) for _ in INSTRUMENTS]}
+        self.counts = {name: [{} for _ in INSTRUMENTS] for name in self.stats}  # value -> number of times added
+
+    def add(self, name, instrument, values):
+        """
+        :param name: bar_length or song_length
+        :param instrument: index of the instrument
+        :param values: values to add
+        """
+        values = np.asarray(values, dtype=np.int64).ravel()
+        self.stats[name][instrument].add(values)
+        counts = self.counts[name][instrument]
+        for value, count in zip(*np.unique(values, return_counts=True)):
+            counts[int(value)] = counts.get(int(value), 0) + int(count)
+
+    def merge(self, other):
+        for name, stats in self.stats.items():
+            for mine, theirs in zip(stats, other.stats[name]):
+                mine.merge(theirs)
+            for mine, theirs in zip(self.counts[name], other.counts[name]):
+                for value, count in theirs.items():
+                    mine[value] = mine.get(value, 0) + count
+
+    def to_counts(self):
+        """
+        :return: values added and their counts, as [[values, counts] of each instrument] by name, None if no value
+        was added
+        """
+        if not any(counts for instruments in self.counts.values() for counts in instruments):
+            return None
+        return {name: [[list(counts.keys()), list(counts.values())] for counts in instruments]
+                for name, instruments in self.counts.items()}
+
+    @classmethod
+    def from_counts(cls, counts):
+        """
+        :param counts: as returned by to_counts
+        :return: statistics of the counted values
+        """
+        stats = cls()
+        for name, instruments in counts.items():
+            for instrument, (values, times) in enumerate(instruments):
+                stats.add(name, instrument, np.repeat(np.array(values, dtype=np.int64), times))
+        return stats
+
+    def total(self, name):
+        """
+        :return: statistics of name over all instruments
+        """
+        total = StreamingStats(self.stats[name][0].upper)
+        for stats in self.stats[name]:
+            total.merge(stats)
+        return total
+
+    def save(self, path):
+        summary = {name: dict({"all": self.total(name).to_dict()},
+                              **{instrument: s.to_dict() for instrument, s in zip(INSTRUMENTS, stats)})
+                   for name, stats in self.stats.items()}
+        replace_file(os.path.join(path, STATISTICS_FILE), lambda f: f.write(json.dumps(summary, indent=1).encode()))
+
+    @classmethod
+    def load(cls, path):
+        """
+        :return: statistics saved in path, empty if there are none
+        """
+        stats = cls()
+        if os.path.exists(os.path.join(path, STATISTICS_FILE)):
+            with open(os.path.join(path, STATISTICS_FILE), "r") as f:
+                summary = json.load(f)
+            stats.stats = {name: [StreamingStats.from_dict(summary[name][instrument]) for instrument in INSTRUMENTS]
+                           for name in stats.stats}
+        return stats
+
+    @staticmethod
+    def save_songs(path, songs):
+        """
+        :param songs: dict song name -> counts of its statistics, as returned by to_counts
+        """
+        replace_file(os.path.join(path, SONG_STATISTICS_FILE), lambda f: f.write(json.dumps(songs).encode()))
+
+    @staticmethod
+    def load_songs(path):
+        """
+        :return: counts of the statistics of each song saved in path, None if there are none
+        """
+        if not os.path.exists(os.path.join(path, SONG_STATISTICS_FILE)):
+            return None
+        with open(os.path.join(path, SONG_STATISTICS_FILE), "r") as f:
+            return json.load(f)
+
+    @staticmethod
+    def plot(path):
+        """
+        Renders the histograms saved in the summary of path
+        """
+        with open(os.path.join(path, STATISTICS_FILE), "r") as f:
+            summary = json.load(f)
+        for name, file_name, y_label, x_label in (("bar_length", "bar_length_distribution.png",
+                                                   "Number of bar with that length", "Bar length"),
+                                                  ("song_length", "song_length_distribution.png",
+                                                   "Number of song with that bars", "Number of bars")):
+            stats = StreamingStats.from_dict(summary[name]["all"])
+            if stats.count == 0:
+                continue
+            # the last bin, with values over the range, goes up to the maximum
+            edges = np.append(np.arange(stats.n_bins + 1) * stats.upper / stats.n_bins,
+                              max(stats.maximum + 1, stats.upper + 1))
+            used = np.flatnonzero(stats.histogram)[-1] + 1  # do not plot empty bins after the maximum
+            plt.hist(edges[:used], bins=edges[:used + 1], weights=stats.histogram[:used],
+                     density=True)  # `density=False` would make counts
+            plt.ylabel(y_label)
+            plt.xlabel(x_label)
+            plt.savefig(file_name)
+            plt.close()
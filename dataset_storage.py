@@ -0,0 +1,345 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+
+META_FILE = "meta.json"
+INDEX_FILE = "index.npy"
+LENGTHS_FILE = "bar_lengths.npy"
+MANIFEST_FILE = "manifest.json"
+SONGS_FILE = "songs.npz"
+
+
+def shard_name(shard):
+    return "shard_{:05d}.bin".format(shard)
+
+
+def file_hash(filepath):
+    with open(filepath, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def mix64(x):
+    """
+    splitmix64 finalizer, used as a family of hash functions on uint64 arrays
+    """
+    with np.errstate(over="ignore"):
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def split_key(name):
+    """
+    :return: uint64 hash of the name of a raw song, the same in every conversion
+    """
+    return int.from_bytes(hashlib.sha1(name.encode()).digest()[:8], "little")
+
+
+def replace_file(path, write):
+    """
+    It writes a file through a temporary one, so that an interruption never leaves it half written
+    """
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        write(f)
+    os.replace(tmp, path)
+
+
+class ShardWriter:
+    """
+    It appends songs to large binary shards in a ragged layout: the tokens of each bar of each instrument, without
+    the padding after them, one after the other, and a table with the number of tokens of each (bar, instrument).
+    The index keeps the (shard, first token, first bar, number of bars) of each song, so that songs can be read
+    back through np.memmap. A song never spans two shards.
+    An existing dataset with the same layout is resumed: new songs go to new shards and dropped songs are
+    marked in the index with shard -1, their tokens are removed by compact
+    """
+
+    def __init__(self, path, n_instruments, max_bar_length, pad, dtype=np.int16, tokens_per_shard=1 << 24):
+        self.path = path
+        self.n_instruments = n_instruments
+        self.max_bar_length = max_bar_length
+        self.pad = pad
+        self.dtype = np.dtype(dtype)
+        self.tokens_per_shard = tokens_per_shard
+        self.index = []
+        self.lengths = []  # arrays with the number of tokens of each (bar, instrument) of each song
+        self.n_bars = 0
+        self.file = None
+        self.resumed = False
+        os.makedirs(path, exist_ok=True)
+        shards = [int(f[len("shard_"):-len(".bin")]) for f in os.listdir(path) if f.startswith("shard_")]
+        if os.path.exists(os.path.join(path, META_FILE)):
+            with open(os.path.join(path, META_FILE), "r") as f:
+                meta = json.load(f)
+            layout = (meta.get("layout"), meta.get("n_instruments"), meta.get("max_bar_length"), meta.get("pad"))
+            if layout == ("ragged", n_instruments, max_bar_length, pad) and meta["dtype"] == self.dtype.name:
+                self.index = np.load(os.path.join(path, INDEX_FILE)).tolist()
+                self.lengths = [np.load(os.path.join(path, LENGTHS_FILE))]
+                self.n_bars = len(self.lengths[0])
+                self.resumed = True
+        if not self.resumed:  # songs stored in another way are useless, start from zero
+            for shard in shards:
+                os.remove(os.path.join(path, shard_name(shard)))
+            shards = []
+        self.shard = max(shards, default=-1)  # never write again in the shards of a previous run
+        self.position = tokens_per_shard
+
+    def append(self, song):
+        """
+        :param song: array with shape (n_instruments, bars, max_bar_length), padded with pad
+        :return: id of the written song
+        """
+        bars = np.swapaxes(song, 0, 1)
+        assert bars.shape[1:] == (self.n_instruments, self.max_bar_length)
+        # tokens of a bar go up to the last token that is not pad
+        not_pad = bars != self.pad
+        lengths = np.where(not_pad.any(axis=-1), self.max_bar_length - np.argmax(not_pad[..., ::-1], axis=-1), 0)
+        tokens = bars[np.arange(self.max_bar_length) < lengths[..., None]]
+        shard, position = self.write(tokens)
+        self.index.append((shard, position, self.n_bars, len(bars)))
+        self.lengths.append(lengths.astype(np.int32))
+        self.n_bars += len(bars)
+        return len(self.index) - 1
+
+    def write(self, tokens):
+        """
+        :param tokens: ragged tokens of a song
+        :return: shard and first token where they were written
+        """
+        if self.position + len(tokens) > self.tokens_per_shard:  # song does not fit in current shard, open a new one
+            if self.file is not None:
+                self.file.close()
+            self.shard += 1
+            self.position = 0
+            self.file = open(os.path.join(self.path, shard_name(self.shard)), "wb")
+        self.file.write(np.ascontiguousarray(tokens, dtype=self.dtype).tobytes())
+        self.position += len(tokens)
+        return self.shard, self.position - len(tokens)
+
+    def drop(self, ids):
+        for idx in ids:
+            self.index[idx] = (-1,) + tuple(self.index[idx][1:])
+
+    def compact(self, threshold=0.5):
+        """
+        Copies the live songs of each shard whose tokens are more than threshold dead, i.e. of dropped songs or
+        of no song, to new shards, and removes the old shards after the index points to the new ones, so that an
+        interruption leaves at most shards of no song, that are removed by the next compaction. Rows of bar lengths
+        of dropped songs are removed too, ids of the songs do not change. It closes the writer
+        :param threshold: fraction of dead tokens over which a shard is rewritten, 1 to only remove empty shards
+        :return: number of shards removed
+        """
+        lengths = np.concatenate(self.lengths).reshape(-1, self.n_instruments) if len(self.lengths) > 0 else \
+            np.zeros((0, self.n_instruments), dtype=np.int32)
+        live = self.live()
+        songs = {}  # shard -> ids of its live songs
+        for idx in live:
+            songs.setdefault(self.index[idx][0], []).append(idx)
+        writing = self.shard if self.file is not None else None  # the open shard is still being filled
+        removed = []
+        for shard in sorted(int(f[len("shard_"):-len(".bin")]) for f in os.listdir(self.path)
+                            if f.startswith("shard_") and f.endswith(".bin")):
+            size = os.path.getsize(os.path.join(self.path, shard_name(shard))) // self.dtype.itemsize
+            live_tokens = sum(int(lengths[first_bar:first_bar + n_bars].sum())
+                              for _, _, first_bar, n_bars in (self.index[idx] for idx in songs.get(shard, [])))
+            if shard == writing or (live_tokens > 0 and size - live_tokens <= threshold * size):
+                continue
+            if live_tokens > 0:
+                tokens = np.memmap(os.path.join(self.path, shard_name(shard)), dtype=self.dtype, mode="r")
+                for idx in sorted(songs[shard], key=lambda i: self.index[i][1]):
+                    _, position, first_bar, n_bars = self.index[idx]
+                    end = position + int(lengths[first_bar:first_bar + n_bars].sum())
+                    self.index[idx] = self.write(tokens[position:end]) + (first_bar, n_bars)
+                del tokens
+            removed.append(shard)
+        # keep only the bar lengths of live songs, dropped ones have no bars
+        first_bars = np.cumsum([0] + [self.index[idx][3] for idx in live])
+        self.lengths = [lengths[self.index[idx][2]:self.index[idx][2] + self.index[idx][3]] for idx in live]
+        self.n_bars = int(first_bars[-1])
+        dropped = set(range(len(self.index))) - set(live)
+        for idx in dropped:
+            self.index[idx] = (-1, 0, 0, 0)
+        for idx, first_bar in zip(live, first_bars):
+            self.index[idx] = tuple(self.index[idx][:2]) + (int(first_bar), self.index[idx][3])
+        self.close()
+        for shard in removed:
+            os.remove(os.path.join(self.path, shard_name(shard)))
+        return len(removed)
+
+    def live(self):
+        """
+        :return: ids of the songs not dropped
+        """
+        return [idx for idx, row in enumerate(self.index) if row[0] >= 0]
+
+    def flush(self):
+        """
+        Makes the songs written so far visible to ShardReader
+        """
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        self.lengths = [np.concatenate(self.lengths).reshape(-1, self.n_instruments)] if len(self.lengths) > 0 else []
+        lengths = self.lengths[0] if len(self.lengths) > 0 else np.zeros((0, self.n_instruments), dtype=np.int32)
+        replace_file(os.path.join(self.path, LENGTHS_FILE), lambda f: np.save(f, lengths))
+        replace_file(os.path.join(self.path, INDEX_FILE),
+                     lambda f: np.save(f, np.array(self.index, dtype=np.int64).reshape(-1, 4)))
+        meta = {"layout": "ragged", "n_instruments": self.n_instruments, "max_bar_length": self.max_bar_length,
+                "pad": self.pad, "dtype": self.dtype.name, "tokens_per_shard": self.tokens_per_shard}
+        replace_file(os.path.join(self.path, META_FILE), lambda f: f.write(json.dumps(meta).encode()))
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.position = self.tokens_per_shard  # songs appended after close go to a new shard
+
+
+class ShardReader:
+    """
+    Random access to the songs written by ShardWriter, shards are memory-mapped when first needed and bars are
+    padded only when they are read
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILE), "r") as f:
+            meta = json.load(f)
+        self.n_instruments = meta["n_instruments"]
+        self.max_bar_length = meta["max_bar_length"]
+        self.pad = meta["pad"]
+        self.dtype = np.dtype(meta["dtype"])
+        self.index = np.load(os.path.join(path, INDEX_FILE))
+        self.lengths = np.load(os.path.join(path, LENGTHS_FILE))
+        self.shards = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def ids(self):
+        """
+        :return: ids of the songs not dropped
+        """
+        return np.flatnonzero(self.index[:, 0] >= 0)
+
+    def n_bars(self, idx):
+        return self.index[idx, 3]
+
+    def bar_lengths(self, idx):
+        """
+        :return: array with the number of tokens of each (bar, instrument) of the song
+        """
+        _, _, first_bar, n_bars = self.index[idx]
+        return self.lengths[first_bar:first_bar + n_bars]
+
+    def window(self, idx, start, length, width=None):
+        """
+        :param idx: id of the song
+        :param start: first bar of the window
+        :param length: number of bars of the window
+        :param width: tokens of each bar, with padding, max_bar_length if None
+        :return: array with shape (n_instruments, length, width)
+        """
+        shard, position, first_bar, n_bars = self.index[idx]
+        assert shard >= 0, "song {} was dropped".format(idx)
+        if shard not in self.shards:
+            self.shards[shard] = np.memmap(os.path.join(self.path, shard_name(shard)), dtype=self.dtype, mode="r")
+        song_lengths = self.lengths[first_bar:first_bar + n_bars]
+        first_token = position + song_lengths[:start].sum()
+        lengths = song_lengths[start:start + length]
+        width = self.max_bar_length if width is None else width
+        bars = np.full((len(lengths), self.n_instruments, width), self.pad, dtype=self.dtype)
+        bars[np.arange(width) < lengths[..., None]] = self.shards[shard][first_token:first_token + lengths.sum()]
+        return np.swapaxes(bars, 0, 1)
+
+    def __getitem__(self, idx):
+        """
+        :return: song with shape (n_instruments, bars, max_bar_length)
+        """
+        return self.window(idx, 0, self.n_bars(idx))
+
+    def __getstate__(self):  # memory maps are opened again by each DataLoader worker
+        state = self.__dict__.copy()
+        state["shards"] = {}
+        return state
+
+
+class Manifest:
+    """
+    It records, for each raw song, its content hash, the preprocessing config it was converted with and
+    the ids of the songs it stored, so that a conversion converts only new or changed songs. The stored songs
+    with the name and split key of their raw song are also saved in a small index for SongIterator
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = os.path.join(path, MANIFEST_FILE)
+        self.configs = {}  # preprocessing configs by digest
+        # song name -> {"hash", "size", "mtime", "config", "samples", "fingerprint", "duplicate_of"}
+        self.songs = {}
+        if os.path.exists(self.file):
+            with open(self.file, "r") as f:
+                manifest = json.load(f)
+            self.configs = manifest["configs"]
+            self.songs = manifest["songs"]
+
+    def add_config(self, preprocessing):
+        """
+        :param preprocessing: dict with the parameters the samples depend on
+        :return: digest that identifies the config
+        """
+        digest = hashlib.sha1(json.dumps(preprocessing, sort_keys=True).encode()).hexdigest()[:16]
+        self.configs[digest] = preprocessing
+        return digest
+
+    def is_converted(self, name, filepath, digest):
+        """
+        :return: True if the song was already converted from the same content with the same config
+        """
+        entry = self.songs.get(name)
+        if entry is None or entry["config"] != digest:
+            return False
+        stat = os.stat(filepath)
+        if entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns:
+            return True
+        if entry["hash"] is not None and file_hash(filepath) == entry["hash"]:  # touched but not changed
+            entry["size"], entry["mtime"] = stat.st_size, stat.st_mtime_ns
+            return True
+        return False
+
+    def add(self, name, filepath, content_hash, digest, samples, fingerprint=None, duplicate_of=None):
+        """
+        :param duplicate_of: name of the song this one is a duplicate of, it is converted again if that one changes
+        """
+        stat = os.stat(filepath)
+        self.songs[name] = {"hash": content_hash, "size": stat.st_size, "mtime": stat.st_mtime_ns,
+                            "config": digest, "samples": samples, "fingerprint": fingerprint,
+                            "duplicate_of": duplicate_of}
+
+    def remove(self, name):
+        """
+        :return: ids of the songs stored for the removed song
+        """
+        return self.songs.pop(name)["samples"]
+
+    def clear(self):
+        self.songs = {}
+
+    def samples(self):
+        return {idx for entry in self.songs.values() for idx in entry["samples"]}
+
+    def save(self):
+        used = {entry["config"] for entry in self.songs.values()}
+        manifest = {"configs": {k: v for k, v in self.configs.items() if k in used}, "songs": self.songs}
+        replace_file(self.file, lambda f: f.write(json.dumps(manifest).encode()))
+        # stored songs with the raw song they come from, read by SongIterator without the whole manifest
+        songs = sorted((idx, name) for name, entry in self.songs.items() for idx in entry["samples"])
+        ids = np.array([idx for idx, _ in songs], dtype=np.int64)
+        names = np.array([name for _, name in songs], dtype=str)
+        split_keys = np.array([split_key(name) for _, name in songs], dtype=np.uint64)
+        replace_file(os.path.join(self.path, SONGS_FILE), lambda f: np.savez(f, ids=ids, names=names,
+                                                                           split_keys=split_keys))
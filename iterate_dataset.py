@@ -1,22 +1,25 @@
 import torch.utils.data
 import os
-import random
-import pickle
+import contextlib
+import collections
+import heapq
+import multiprocessing
+import time
 from torch.utils.data import SubsetRandomSampler
 from config import config
 import numpy as np
+from dataset_storage import ShardReader, SONGS_FILE, mix64
+from utilities import batch_to_device
 
 
 class SongIterator(torch.utils.data.Dataset):
     def __init__(self, dataset_path, test_size, max_len=3000, batch_size=3, n_workers=1):
         self.dataset_path = dataset_path
         print(dataset_path)
-        _, _, songs = next(os.walk(self.dataset_path))
-        self.songs = [x.split(".")[0] for x in songs]
-        random.shuffle(self.songs)
-        ts_length = int(len(songs) * test_size)
-        self.ts_set = self.songs[:ts_length]
-        self.tr_set = self.songs[ts_length:]
+        self.reader = ShardReader(dataset_path)
+        self.windows = self.make_windows(config["train"]["n_bars"], config["train"]["window_stride"])
+        self.widths = self.window_widths()
+        self.ts_set, self.tr_set = self.split(test_size, config["train"]["split_seed"])
         self.batch_size = batch_size
         self.max_len = max_len
         if len(self.tr_set) < batch_size:
@@ -24,34 +27,99 @@ class SongIterator(torch.utils.data.Dataset):
         if len(self.ts_set) < batch_size:
             raise Exception("Testing set is too little w.r.t. the batch size")
         self.n_workers = n_workers
+        self.causal_masks = {}  # width -> causal mask
+        self.cache = None
+        if config["train"]["cache_size"] > 0:
+            self.cache = SampleCache(self.widths, (4, config["train"]["n_bars"]), config["train"]["cache_size"],
+                                     config["train"]["cache_shared"])
+
+    def make_windows(self, length, stride=None):
+        """
+        Windows are views of the stored songs, so they can overlap and have any length without extra storage.
+        With a stride longer than length, a window is the beginning of a run of stride bars, and the last run of a
+        song must be complete: with the default stride, these are the samples of truncated_bars bars of which
+        training took the first n_bars
+        :param length: bars of a window
+        :param stride: bars between the start of two windows of a song, config["data"]["truncated_bars"] if None
+        :return: array of windows (song id, start bar, length)
+        """
+        stride = config["data"]["truncated_bars"] if stride is None else stride
+        songs = self.reader.ids()
+        n_windows = np.maximum((self.reader.n_bars(songs) - max(length, stride)) // stride + 1, 0)
+        songs = np.repeat(songs, n_windows)
+        # position of each window in its song
+        starts = (np.arange(len(songs)) - np.repeat(np.cumsum(n_windows) - n_windows, n_windows)) * stride
+        return np.stack([songs, starts, np.full(len(songs), length)], axis=1).astype(np.int64)
+
+    def window_widths(self):
+        """
+        Uses the bar lengths written by the conversion
+        :return: array with the tokens of the longest bar of each window, with space for eos in src and trg
+        """
+        if len(self.windows) == 0:
+            return np.zeros(0, dtype=np.int64)
+        # windows never go over their song, so they are windows of the table of all the bars
+        longest = np.lib.stride_tricks.sliding_window_view(self.reader.lengths.max(axis=1), self.windows[0, 2])
+        first_bars = self.reader.index[self.windows[:, 0], 2] + self.windows[:, 1]
+        return np.minimum(longest.max(axis=1)[first_bars] + 2, config["model"]["seq_len"]).astype(np.int64)
+
+    def split(self, test_size, seed):
+        """
+        Windows of a raw song are all in the same set. Raw songs are ordered by a hash of their name and of seed, the
+        first ones go to the test set until it has test_size of the windows, so the split is the same in every run
+        :return: ids of the windows of the test set and of the training set
+        """
+        if not os.path.exists(os.path.join(self.dataset_path, SONGS_FILE)):
+            raise Exception("Missing " + SONGS_FILE + ", run the dataset conversion again to write it")
+        songs = np.load(os.path.join(self.dataset_path, SONGS_FILE))
+        keys = np.zeros(len(self.reader), dtype=np.uint64)
+        keys[songs["ids"]] = mix64(songs["split_keys"] ^ mix64(np.uint64(seed)))
+        order = np.argsort(keys[self.windows[:, 0]], kind="stable")
+        ts_length = int(len(self.windows) * test_size)
+        if ts_length > 0:  # complete the song of the last test window
+            ts_length = np.searchsorted(keys[self.windows[order, 0]], keys[self.windows[order[ts_length - 1], 0]],
+                                        side="right")
+        return order[:ts_length].tolist(), order[ts_length:].tolist()
 
     def __getitem__(self, idx):
-        with open(os.path.join(self.dataset_path, idx+str('.pickle')), 'rb') as file:
-            src = pickle.load(file)
-        # src = src[:, :(src.shape[1]-src.shape[1] % config["train"]["truncated_bars"]), :]
-        # src = src.reshape(4, -1, config["train"]["truncated_bars"], config["model"]["seq_len"])
-        src = src[:, :config["train"]["n_bars"], :]
+        width = config["model"]["seq_len"]
+        src = self.cache.get(idx, width) if self.cache is not None else None
+        if src is None:
+            src = self.decode_window(idx, width)
+            if self.cache is not None:  # the window is the same at any width from its own one
+                self.cache.put(idx, src[..., :self.widths[idx]])
+        if not config["train"]["loader_masks"]:  # trg and masks are built on the device
+            return src
         sos = np.full(src.shape[:-1]+(1,), config["tokens"]["sos"], dtype=src.dtype)
         src = np.append(sos, src, axis=-1)
-        for instrument in src:
-            for bar in instrument:
-                idx = np.where(bar == config["tokens"]["pad"])
-                bar[idx[0][0]] = config["tokens"]["eos"]
         src_mask = src != config["tokens"]["pad"]
         trg = src[..., :-1]
         trg_y = src[..., 1:]
-        trg_mask = np.full(trg.shape+(trg.shape[-1],), True)
-        for i, instrument in enumerate(trg):
-            for b, bar in enumerate(instrument):
-                line_mask = bar != config["tokens"]["pad"]
-                pad_mask = np.matmul(line_mask[:, np.newaxis], line_mask[np.newaxis, :])
-                subsequent_mask = np.expand_dims(np.tril(np.ones((trg.shape[-1], trg.shape[-1]))), (0, 1))
-                subsequent_mask = subsequent_mask.astype(np.bool)
-                trg_mask[i][b] = pad_mask & subsequent_mask
+        line_mask = src_mask[..., :-1]
+        trg_mask = line_mask[..., :, None] & line_mask[..., None, :] & self.causal_mask(trg.shape[-1])
         src = src[..., 1:]
         src_mask = src_mask[..., 1:]
         return src, trg, src_mask, trg_mask, trg_y
 
+    def decode_window(self, idx, width):
+        """
+        :return: tokens of the window with shape (4, bars, width), with eos on the first pad of each bar
+        """
+        song, start, length = self.windows[idx]
+        src = self.reader.window(song, start, length, width)
+        is_pad = src == config["tokens"]["pad"]
+        instruments, bars = np.nonzero(is_pad.any(axis=-1))
+        src[instruments, bars, np.argmax(is_pad, axis=-1)[instruments, bars]] = config["tokens"]["eos"]
+        return src
+
+    def causal_mask(self, width):
+        """
+        :return: boolean lower triangular matrix with shape (width, width), created once for each width
+        """
+        if width not in self.causal_masks:
+            self.causal_masks[width] = np.tril(np.ones((width, width), dtype=bool))
+        return self.causal_masks[width]
+
     def __len__(self, train=None):
         if train:
             return len(self.tr_set)
@@ -59,25 +127,239 @@ class SongIterator(torch.utils.data.Dataset):
             return len(self.ts_set)
 
     def get_loaders(self):
-        tr_sampler = SubsetRandomSampler(self.tr_set)  # TODO random sampling does not ruins flow of a song?
-        ts_sampler = SubsetRandomSampler(self.ts_set)
-
-        tr_loader = torch.utils.data.DataLoader(
-            self,
-            batch_size=self.batch_size,
-            sampler=tr_sampler,
-            num_workers=self.n_workers,
-            drop_last=True  # if dataset length is not divisible by batch_size, drop last batch
-        )
-
-        ts_loader = torch.utils.data.DataLoader(
-            self,
-            batch_size=self.batch_size,
-            sampler=ts_sampler,
-            num_workers=self.n_workers,
-            drop_last=True
-        )
+        loaders = []
+        workers = {"num_workers": self.n_workers,
+                   "pin_memory": config["train"]["pin_memory"] and torch.cuda.is_available()}
+        if self.n_workers > 0:  # workers live for all the training and keep prefetch_factor batches ready
+            workers.update(persistent_workers=True, prefetch_factor=config["train"]["prefetch_factor"])
+        for indices in (self.tr_set, self.ts_set):
+            if config["train"]["contiguous_songs"]:  # consecutive windows of a song in consecutive batches
+                loaders.append(torch.utils.data.DataLoader(
+                    self,
+                    batch_sampler=SongContiguousBatchSampler(indices, self.windows, self.batch_size),
+                    **workers
+                ))
+            else:
+                loaders.append(torch.utils.data.DataLoader(
+                    self,
+                    batch_size=self.batch_size,
+                    sampler=SubsetRandomSampler(indices),  # TODO random sampling does not ruins flow of a song?
+                    drop_last=True,  # if dataset length is not divisible by batch_size, drop last batch
+                    **workers
+                ))
+        tr_loader, ts_loader = loaders
         return tr_loader, ts_loader
 
     def get_random_item(self):
         return self.__getitem__(0)
+
+
+class SampleCache:
+    """
+    Decoded windows kept in memory up to a size in bytes, the least recently used one is replaced when it is full.
+    Each window is kept at its own width, in a slot of the class of widths it belongs to, so short windows take
+    little space. Slots are in tensors that are in shared memory if the cache is shared, so that all the
+    DataLoader workers use and fill the same cache. Each class of widths has its slots in a doubly linked list from
+    the most to the least recently used, so both get and put take constant time
+    """
+
+    def __init__(self, widths, window_shape, size, shared=True, step=16):
+        """
+        :param widths: width of every window of the dataset
+        :param window_shape: shape of a window without the width
+        :param size: bytes of the cached windows
+        :param shared: if the cache is in shared memory
+        :param step: width classes are multiples of step
+        """
+        widths = np.asarray(widths, dtype=np.int64)
+        if shared and hasattr(os, "statvfs") and os.path.isdir("/dev/shm"):  # e.g. docker gives just 64 MB by default
+            stat = os.statvfs("/dev/shm")
+            if size > stat.f_bavail * stat.f_frsize // 2:
+                size = stat.f_bavail * stat.f_frsize // 2
+                print("Cache reduced to", size, "bytes, half of the free space in /dev/shm")
+        self.step = step
+        self.window_size = int(np.prod(window_shape))
+        # slots of each class get the same share of the bytes of its windows
+        classes = -(-widths // step)
+        counts = np.bincount(classes, minlength=1)
+        class_bytes = np.arange(len(counts)) * step * self.window_size * 2
+        fraction = min(size / max(int((counts * class_bytes).sum()), 1), 1.)
+        n_slots = np.floor(counts * fraction).astype(np.int64)
+        self.tokens = [torch.empty((int(n),) + tuple(window_shape) + (c * step,), dtype=torch.int16)
+                       for c, n in enumerate(n_slots)]
+        total = int(n_slots.sum())
+        first_slots = np.concatenate(([0], np.cumsum(n_slots)))
+        # global slot i is slot offsets[i] of class classes[i], total + c is the head of the list of class c
+        self.slot_classes = torch.from_numpy(np.repeat(np.arange(len(counts)), n_slots))
+        self.offsets = torch.from_numpy(np.arange(total) - np.repeat(first_slots[:-1], n_slots))
+        self.heads = torch.arange(total, total + len(counts), dtype=torch.int64)
+        self.next = torch.empty(total + len(counts), dtype=torch.int64)
+        self.previous = torch.empty(total + len(counts), dtype=torch.int64)
+        for c in range(len(counts)):  # circular list head, first slot, ..., last slot
+            nodes = torch.cat((self.heads[c:c + 1], torch.arange(first_slots[c], first_slots[c + 1])))
+            self.next[nodes] = torch.roll(nodes, -1)
+            self.previous[nodes] = torch.roll(nodes, 1)
+        self.keys = torch.full((total, 2), -1, dtype=torch.int64)  # (window, width) in each slot
+        self.slots = torch.full((len(widths),), -1, dtype=torch.int64)  # slot of each window, -1 if not cached
+        self.counters = torch.zeros(2, dtype=torch.int64)  # hits, misses
+        self.lock = multiprocessing.Lock() if shared else contextlib.nullcontext()
+        if shared:
+            for tensor in self.tokens + [self.keys, self.slots, self.counters, self.next, self.previous]:
+                tensor.share_memory_()
+
+    def use(self, slot):
+        """
+        Moves slot to the front of the list of its class, as the most recently used
+        """
+        head = int(self.heads[self.slot_classes[slot]])
+        previous, following = int(self.previous[slot]), int(self.next[slot])
+        self.next[previous], self.previous[following] = following, previous
+        first = int(self.next[head])
+        self.next[slot], self.previous[slot] = first, head
+        self.next[head], self.previous[first] = slot, slot
+
+    def get(self, window, width):
+        """
+        :return: copy of the cached window padded to width or None
+        """
+        with self.lock:
+            slot = int(self.slots[window])
+            if slot < 0:
+                self.counters[1] += 1
+                return None
+            self.counters[0] += 1
+            self.use(slot)
+            tokens = self.tokens[self.slot_classes[slot]][self.offsets[slot], ..., :int(self.keys[slot, 1])].numpy()
+            return np.pad(tokens, ((0, 0), (0, 0), (0, width - tokens.shape[-1])),
+                          constant_values=config["tokens"]["pad"])
+
+    def put(self, window, tokens):
+        """
+        :param window: id of the window
+        :param tokens: array with shape (4, bars, width), width is the one of the window
+        """
+        width_class = -(-tokens.shape[-1] // self.step)
+        if width_class >= len(self.tokens) or len(self.tokens[width_class]) == 0:
+            return
+        with self.lock:
+            slot = int(self.slots[window])
+            if slot < 0:  # replace least recently used window of the class
+                slot = int(self.previous[self.heads[width_class]])
+                if self.keys[slot, 0] >= 0:
+                    self.slots[self.keys[slot, 0]] = -1
+            self.tokens[width_class][self.offsets[slot], ..., :tokens.shape[-1]] = torch.from_numpy(tokens)
+            self.keys[slot, 0], self.keys[slot, 1] = window, tokens.shape[-1]
+            self.slots[window] = slot
+            self.use(slot)
+
+    def stats(self):
+        """
+        :return: hits and misses so far, of all the workers only if the cache is shared
+        """
+        return int(self.counters[0]), int(self.counters[1])
+
+
+class SongContiguousBatchSampler(torch.utils.data.Sampler):
+    """
+    Each position of the batch follows a song, giving its windows in order in consecutive batches, so that the
+    memories of a window can be carried to the next one. When the song of a position ends, the position goes on
+    with the next song of a random order, and the epoch ends when there are no more songs to start.
+    For each batch, the positions that start a song are queued in firsts, in the same order as the batches: the
+    loader gives batches in order, so the trainer takes them from the queue as it gets the batches.
+    The order of an epoch is drawn before it starts, so that its length is known
+    """
+
+    def __init__(self, indices, windows, batch_size):
+        """
+        :param indices: windows to sample
+        :param windows: windows (song id, start bar, length) of the dataset
+        :param batch_size: songs followed at the same time
+        """
+        super(SongContiguousBatchSampler, self).__init__()
+        indices = np.asarray(indices, dtype=np.int64)
+        indices = indices[np.lexsort((windows[indices, 1], windows[indices, 0]))]  # by song, then by start
+        songs, first = np.unique(windows[indices, 0], return_index=True)
+        self.songs = [song for song in np.split(indices, first[1:]) if len(song) > 0]  # windows of each song, in order
+        self.batch_size = batch_size
+        self.firsts = collections.deque()
+        self.order = None  # order of the songs of the next epoch, or of the current one while it is iterated
+        self.length = 0  # batches given with order
+        self.draw()
+
+    def draw(self):
+        """
+        Draws the order of the songs of the next epoch and counts its batches: positions take the next song in the
+        batch where theirs ends, the first one by position within a batch, and the epoch ends in the first batch
+        where a position finds no song left
+        """
+        self.order = np.random.permutation(len(self.songs))
+        ends = [(0, p) for p in range(self.batch_size)]  # heap of the batch where each position needs a new song
+        for song in self.order:
+            end, p = heapq.heappop(ends)
+            heapq.heappush(ends, (end + len(self.songs[song]), p))
+        self.length = ends[0][0]
+
+    def __iter__(self):
+        self.firsts.clear()
+        order = iter(self.order)
+        positions = [[] for _ in range(self.batch_size)]
+        try:
+            while True:
+                first = np.zeros(self.batch_size, dtype=bool)
+                for p in range(self.batch_size):
+                    if len(positions[p]) == 0:
+                        song = next(order, None)
+                        if song is None:
+                            return
+                        positions[p] = list(self.songs[song])
+                        first[p] = True
+                self.firsts.append(torch.from_numpy(first))
+                yield [int(position.pop(0)) for position in positions]
+        finally:  # also when the epoch is left before its end
+            self.draw()
+
+    def __len__(self):
+        return self.length
+
+
+class DevicePrefetcher:
+    """
+    Iterates over the batches of a loader already on the device, as returned by batch_to_device. The copy of the
+    next batch is issued, on a separate CUDA stream, before the current one is given, so it overlaps with the
+    computation of the current step. stall is the time the last step waited for its batch, not counting the wait for
+    the first batch, when the loader workers start
+    """
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+        self.stall = 0.
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        batches = iter(self.loader)
+        batch = self.load(batches)
+        start = time.perf_counter()
+        while batch is not None:
+            if self.stream is not None:  # batch is used on the main stream after its copy
+                torch.cuda.current_stream(self.device).wait_stream(self.stream)
+                for tensor in batch:
+                    tensor.record_stream(torch.cuda.current_stream(self.device))
+            next_batch = self.load(batches)
+            self.stall = time.perf_counter() - start
+            yield batch
+            start = time.perf_counter()
+            batch = next_batch
+
+    def load(self, batches):
+        """
+        :return: next batch of the loader on the device, None at the end
+        """
+        batch = next(batches, None)
+        if batch is None:
+            return None
+        with torch.cuda.stream(self.stream) if self.stream is not None else contextlib.nullcontext():
+            return batch_to_device(batch, non_blocking=True)
@@ -45,6 +45,16 @@ class Logger:
         log["stuff/tf_prob"] = tf_prob
         wandb.log(log)
 
+    @staticmethod
+    def log_loader(stall, cache_stats=None):
+        log = {"loader/stall ms": stall * 1000}
+        if cache_stats is not None:
+            hits, misses = cache_stats
+            log["loader/cache hits"] = hits
+            log["loader/cache misses"] = misses
+            log["loader/cache hit rate"] = hits / (hits + misses) if hits + misses > 0 else 0.
+        wandb.log(log)
+
     @staticmethod
     def log_examples(e_in, d_in, pred, exp):
         enc_input = e_in.transpose(0, 2)[0].detach().cpu().numpy()
@@ -0,0 +1,167 @@
+import os
+import json
+import struct
+import multiprocessing
+from dataset_storage import replace_file, file_hash
+
+
+CATALOG_FILE = "lmd_matched_catalog.json"
+
+
+def read_variable_length(data, pos):
+    """
+    :return: value of the MIDI variable-length quantity starting at pos and the position after it
+    """
+    value = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value = (value << 7) | (byte & 0x7F)
+        if byte < 0x80:
+            return value, pos
+
+
+def scan_midi(filepath):
+    """
+    Reads a MIDI file without building its messages, collecting only what filter_song looks at: the time
+    signatures and, like muspy does, a track for each (program, channel) of each MIDI track with its note count
+    :param filepath: path of the MIDI file
+    :return: dict with type, ticks, time signatures and tracks (program, is_drum, notes), or with readable False
+    if mido surely fails to read the file, None if it is not clear how muspy would read it
+    """
+    if not filepath.lower().endswith((".mid", ".midi")):  # muspy reads other formats
+        return None
+    try:
+        with open(filepath, "rb") as f:
+            data = f.read()
+        if data[:4] != b"MThd" or len(data) < 14:
+            return {"readable": False}
+        length = struct.unpack(">I", data[4:8])[0]
+        if length < 6:
+            return {"readable": False}
+        midi_type, n_tracks, ticks = struct.unpack(">hhh", data[8:14])  # mido reads them signed
+        pos = 8 + length
+        time_signatures = []
+        tracks = {}
+        for _ in range(n_tracks):
+            if pos + 8 > len(data):  # missing track
+                return {"readable": False}
+            name, length = data[pos:pos + 4], struct.unpack(">I", data[pos + 4:pos + 8])[0]
+            pos += 8
+            end = pos + length
+            if name != b"MTrk" or end > len(data):  # mido reads until the end of the chunk
+                return {"readable": False}
+            programs = [0] * 16
+            track_notes = {}
+            running = None
+            while pos < end:
+                _, pos = read_variable_length(data, pos)  # delta time
+                if data[pos] >= 0x80:
+                    status = data[pos]
+                    pos += 1
+                    if status != 0xFF:  # like mido, meta messages do not set running status
+                        running = status
+                elif running is None or running >= 0xF0:
+                    return None
+                else:
+                    status = running
+                if status == 0xFF:  # meta message
+                    meta_type = data[pos]
+                    length, pos = read_variable_length(data, pos + 1)
+                    if meta_type == 0x58:  # time signature
+                        if length != 4:
+                            return None
+                        time_signatures.append((data[pos], 2 ** data[pos + 1]))
+                    pos += length
+                    if meta_type == 0x2F:  # end of track, muspy stops here
+                        break
+                elif status in (0xF0, 0xF7):  # sysex
+                    length, pos = read_variable_length(data, pos)
+                    pos += length
+                elif status >= 0xF0:
+                    return None
+                else:
+                    kind, channel = status & 0xF0, status & 0x0F
+                    if kind == 0xC0:  # program change
+                        programs[channel] = data[pos]
+                    elif kind in (0x80, 0x90, 0xB0):  # messages that can create a muspy track
+                        key = (programs[channel], channel)
+                        track_notes[key] = track_notes.get(key, 0) + (kind == 0x90 and data[pos + 1] > 0)
+                    pos += 1 if kind in (0xC0, 0xD0) else 2
+            if pos > end:  # a message goes over the chunk
+                return None
+            pos = end
+            for channel in {channel for _, channel in track_notes}:  # notes never closed go to the last program
+                track_notes.setdefault((programs[channel], channel), 0)
+            for (program, channel), notes in track_notes.items():
+                tracks[(program, channel == 9)] = tracks.get((program, channel == 9), 0) + notes
+    except (IndexError, struct.error, OSError):
+        return None
+    return {"readable": True, "type": midi_type, "ticks": ticks, "time_signatures": sorted(set(time_signatures)),
+            "tracks": [[program, is_drum, notes] for (program, is_drum), notes in sorted(tracks.items())]}
+
+
+def scan_file(filepath):
+    """
+    :return: content hash of the file and its metadata, as returned by scan_midi
+    """
+    return file_hash(filepath), scan_midi(filepath)
+
+
+class MidiCatalog:
+    """
+    Cheap metadata of the raw MIDI files, kept next to them and updated only for new or changed files, so that
+    the conversion skips songs that cannot pass filter_song without reading them, whatever the data config is
+    """
+
+    def __init__(self, path):
+        self.file = os.path.join(path, CATALOG_FILE)
+        self.files = {}  # song name -> {"size", "mtime", "hash", "midi"}
+        if os.path.exists(self.file):
+            with open(self.file, "r") as f:
+                self.files = json.load(f)["files"]
+
+    def is_scanned(self, name, filepath):
+        entry = self.files.get(name)
+        if entry is None or "hash" not in entry:  # scanned before hashes were kept
+            return False
+        stat = os.stat(filepath)
+        return entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns
+
+    def update(self, songs, n_workers=1, chunk_size=16):
+        """
+        Scans the songs not in the catalog or changed since they were scanned
+        :param songs: list of tuples (song name, file path)
+        :param n_workers: number of processes used to scan
+        :param chunk_size: songs sent to a process at a time
+        :return: number of scanned songs
+        """
+        songs = [(name, filepath) for name, filepath in songs if not self.is_scanned(name, filepath)]
+        filepaths = [filepath for _, filepath in songs]
+        if n_workers > 1 and len(songs) > 0:
+            with multiprocessing.Pool(n_workers) as pool:
+                results = pool.map(scan_file, filepaths, chunksize=chunk_size)
+        else:
+            results = map(scan_file, filepaths)
+        for (name, filepath), (content_hash, midi) in zip(songs, results):
+            stat = os.stat(filepath)
+            self.files[name] = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "hash": content_hash, "midi": midi}
+        return len(songs)
+
+    def get(self, name):
+        """
+        :return: metadata of the song as returned by scan_midi, None if unknown
+        """
+        entry = self.files.get(name)
+        return None if entry is None else entry["midi"]
+
+    def hash(self, name):
+        """
+        :return: content hash of the song when it was scanned, None if unknown
+        """
+        entry = self.files.get(name)
+        return None if entry is None else entry.get("hash")
+
+    def save(self):
+        replace_file(self.file, lambda f: f.write(json.dumps({"files": self.files},
+                                                             separators=(",", ":")).encode()))
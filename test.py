@@ -7,8 +7,9 @@ import numpy as np
 from utilities import get_prior
 from iterate_dataset import SongIterator
 from create_bar_dataset import NoteRepresentationManager
-from utilities import create_trg_mask
+from utilities import create_trg_mask, batch_to_device
 from config import remote
+from compressive_transformer import INSTRUMENTS
 import copy
 
 
@@ -21,12 +22,10 @@ class Tester:
     def interpolation(self, note_manager, first, second):
         # Encode first
         e_mems, e_cmems, _, _ = get_memories()
-        srcs, _, src_masks, _, _ = first
+        srcs, _, src_masks, _, _ = first  # on device
         latent = None
-        srcs = srcs[0].unsqueeze(0)  # select first song of the batch
-        src_masks = src_masks[0].unsqueeze(0)  # add batch dimension of size 1
-        srcs = torch.LongTensor(srcs.long()).to(config["train"]["device"]).transpose(0, 2)
-        src_masks = torch.BoolTensor(src_masks).to(config["train"]["device"]).transpose(0, 2)
+        srcs = srcs[:, :, :1]  # select first song of the batch
+        src_masks = src_masks[:, :, :1]
         for src, src_mask in zip(srcs, src_masks):
             latent, e_mems, e_cmems, e_attn_loss, sw = self.encoder(src, src_mask, e_mems, e_cmems)
             e_mems = e_mems.detach()
@@ -36,10 +35,8 @@ class Tester:
         # Encode second
         e_mems, e_cmems, _, _ = get_memories()
         srcs, _, src_masks, _, _ = second
-        srcs = srcs[0].unsqueeze(0)  # select first song of the batch
-        src_masks = src_masks[0].unsqueeze(0)  # add batch dimension of size 1
-        srcs = torch.LongTensor(srcs.long()).to(config["train"]["device"]).transpose(0, 2)
-        src_masks = torch.BoolTensor(src_masks).to(config["train"]["device"]).transpose(0, 2)
+        srcs = srcs[:, :, :1]  # select first song of the batch
+        src_masks = src_masks[:, :, :1]
         for src, src_mask in zip(srcs, src_masks):
             latent, e_mems, e_cmems, e_attn_loss, sw = self.encoder(src, src_mask, e_mems, e_cmems)
             e_mems = e_mems.detach()
@@ -77,6 +74,32 @@ class Tester:
 
         return one, full, two
 
+    def bar_cache(self, latent, d_mems, d_cmems):
+        """
+        :return: cache of the decoder to decode a new bar with next_tokens, None without step_decoding
+        """
+        if not config["train"]["step_decoding"]:
+            return None
+        return self.decoder.cache(latent, d_mems, d_cmems)
+
+    def next_tokens(self, trg, cache, latent, d_mems, d_cmems, emb_weights=None, just=None):
+        """
+        Output of the decoder for the last token of trg, from the cache of the tokens before it with step_decoding,
+        otherwise recomputing the whole prefix
+        :param trg: tokens of the bar decoded until now, as for the decoder, with emb_weights and just
+        :param cache: as returned by bar_cache or next_tokens for the tokens before the last one
+        :return: output of the last token and cache with it
+        """
+        if config["train"]["step_decoding"]:
+            if emb_weights is not None:
+                return self.decoder.step(trg[..., -1:, :], cache, emb_weights=emb_weights[..., -1:, :], just=just)
+            return self.decoder.step(trg[..., -1:], cache, just=just)
+        lines = trg[..., 0] if emb_weights is not None else trg
+        trg_mask = create_trg_mask(lines) if just is None else create_trg_mask(lines[None])[0]
+        out, _, _, _, _, _ = self.decoder(trg, trg_mask, None, latent, d_mems, d_cmems, just=just,
+                                          emb_weights=emb_weights)
+        return out[..., -1:, :], cache
+
     def greedy_topk_decode(self, latent, n_bars, desc, k=5):
         _, _, d_mems, d_cmems = get_memories(n_batch=1)
         outs = []
@@ -84,9 +107,9 @@ class Tester:
             trg = np.full((4, 1, 1), config["tokens"]["sos"])
             trg = torch.LongTensor(trg).to(config["train"]["device"]).unsqueeze(-1).repeat(1, 1, 1, k)
             prob = torch.full_like(trg, 1/k, device=config["train"]["device"], dtype=torch.float32)
+            cache = self.bar_cache(latent, d_mems, d_cmems)
             for _ in range(config["model"]["seq_len"] - 1):  # for each token of each bar
-                trg_mask = create_trg_mask(trg[..., 0].cpu().numpy())
-                out, _, _, _, _, _ = self.decoder(trg, trg_mask, None, latent, d_mems, d_cmems, emb_weights=prob)
+                out, cache = self.next_tokens(trg, cache, latent, d_mems, d_cmems, emb_weights=prob)
 
                 top_k = torch.topk(out, config["train"]["top_k_mixed_embeddings"], dim=-1)
                 last_trg = top_k.indices  # 8 1 200 5 4
@@ -106,7 +129,7 @@ class Tester:
                 trg = torch.cat((trg, last_trg), dim=-2)
                 prob = torch.cat((prob, scaled_prob), dim=-2)
 
-            trg_mask = create_trg_mask(trg[..., 0].cpu().numpy())
+            trg_mask = create_trg_mask(trg[..., 0])
             out, _, _, d_mems, d_cmems, _ = self.decoder(trg, trg_mask, None, latent, d_mems, d_cmems, emb_weights=prob)
             out = torch.max(out, dim=-1).indices
             for i in range(len(out)):
@@ -125,12 +148,12 @@ class Tester:
         for _ in tqdm(range(n_bars), position=0, leave=True, desc=desc):
             trg = np.full((4, 1, 1), config["tokens"]["sos"])
             trg = torch.LongTensor(trg).to(config["train"]["device"])
+            cache = self.bar_cache(latent, d_mems, d_cmems)
             for _ in range(config["model"]["seq_len"] - 1):  # for each token of each bar
-                trg_mask = create_trg_mask(trg.cpu().numpy())
-                out, _, _, _, _, _ = self.decoder(trg, trg_mask, None, latent, d_mems, d_cmems)
+                out, cache = self.next_tokens(trg, cache, latent, d_mems, d_cmems)
                 out = torch.max(out, dim=-1).indices
                 trg = torch.cat((trg, out[..., -1:]), dim=-1)
-            trg_mask = create_trg_mask(trg.cpu().numpy())
+            trg_mask = create_trg_mask(trg)
             out, _, _, d_mems, d_cmems, _ = self.decoder(trg, trg_mask, None, latent, d_mems, d_cmems)
             out = torch.max(out, dim=-1).indices
             outs.append(copy.deepcopy(out))
@@ -149,28 +172,20 @@ class Tester:
         for _ in tqdm(range(n_bars), position=0, leave=True, desc=desc):
             trg = np.full((4, 1, 1), config["tokens"]["sos"])
             trg = torch.LongTensor(trg).to(config["train"]["device"])
-            candidates = [(trg, 0.)]
+            candidates = [(trg, 0., self.bar_cache(latent, d_mems, d_cmems))]
             for _ in range(config["model"]["seq_len"] - 1):  # for each token of each bar
                 new_candidates = []
-                for candidate in candidates:
-                    trg, score = candidate
-                    # trg_mask = create_trg_mask(trg.cpu().numpy())
-                    out, _, _, _, _, _ = self.decoder(trg, None, None, latent, d_mems, d_cmems)
-                    out = torch.topk(out, k, dim=-2)
-                    tok = out.indices
-                    for i in range(k):
-                        c = tok[:, :, i, :]
-                        o = c.permute(2, 0, 1)
-                        t = (torch.cat((trg, o[..., -1:]), dim=-1), score - torch.sum(out.values[:, -1:, i, :]).item())
-                        new_candidates.append(t)
-                new_candidates = sorted(new_candidates, key=lambda x: x[1])  # TODO is this sorting right?
-                new_candidates = new_candidates[:k]
-                candidates = new_candidates
-            # trg_mask = create_trg_mask(trg.cpu().numpy())
+                for trg, score, cache in candidates:
+                    out, cache = self.next_tokens(trg, cache, latent, d_mems, d_cmems)
+                    out = torch.topk(out, k, dim=-1)
+                    for i in range(k):  # i-th best token of each instrument, the new candidates share the cache
+                        new_candidates.append((torch.cat((trg, out.indices[..., i]), dim=-1),
+                                               score - torch.sum(out.values[..., i]).item(), cache))
+                candidates = sorted(new_candidates, key=lambda x: x[1])[:k]  # lowest negative log likelihood
             trg = candidates[0][0]
-            out, _, _, d_mems, d_cmems, _ = self.decoder(trg, None, None, latent, d_mems, d_cmems)
-            out = torch.max(out, dim=-2).indices
-            out = out.permute(2, 0, 1)
+            trg_mask = create_trg_mask(trg)
+            out, _, _, d_mems, d_cmems, _ = self.decoder(trg, trg_mask, None, latent, d_mems, d_cmems)
+            out = torch.max(out, dim=-1).indices
             outs.append(out)
         return outs
 
@@ -179,52 +194,26 @@ class Tester:
         outs = []
         for _ in tqdm(range(n_bars), position=0, leave=True, desc=desc):
             trg = np.full((1, 1), config["tokens"]["sos"])
-            pad = np.full((1, 1), config["tokens"]["pad"])
             trg = torch.LongTensor(trg).to(config["train"]["device"])
-            pad = torch.LongTensor(pad).to(config["train"]["device"])
-
-            drums_candidates = [(trg, 0.)]
-            bass_candidates = [(trg, 0.)]
-            guitar_candidates = [(trg, 0.)]
-            strings_candidates = [(trg, 0.)]
-            instruments = [drums_candidates, bass_candidates, guitar_candidates, strings_candidates]
+            cache = self.bar_cache(latent, d_mems, d_cmems)
+            # drums, bass, guitar and strings candidates
+            instruments = [[(trg, 0., cache[i] if cache is not None else None)] for i in range(4)]
 
             for _ in range(config["model"]["seq_len"] - 1):  # for each token of each bar
-                idx = 0
-                for candidates, name in zip(instruments, ["drums", "bass", "guitar", "strings"]):
+                for idx, name in enumerate(INSTRUMENTS):
                     new_candidates = []
-                    for candidate in candidates:
-                        trg, score = candidate
-                        # if trg[0][-1] == config["tokens"]["pad"]:
-                        #     t = (
-                        #         torch.cat((trg, pad), dim=-1),
-                        #         score + 1.5)
-                        #     new_candidates.append(t)
-                        #     continue
-                        trg_mask = create_trg_mask(trg.unsqueeze(0).cpu().numpy())[0]  # TODO check
-                        out, _, _, _, _, _ = self.decoder(trg, trg_mask, None, latent, d_mems, d_cmems, just=name)
+                    for trg, score, instrument_cache in instruments[idx]:
+                        out, instrument_cache = self.next_tokens(trg, instrument_cache, latent, d_mems, d_cmems,
+                                                                 just=name)
                         out = torch.topk(out, k, dim=-1)
-                        tok = out.indices
                         for i in range(k):
-                            c = tok[:, :, i]  # TODO if 3 then stop
-                            # if c[0][-1:].item() == config["tokens"]["eos"]:
-                            #     t = (
-                            #         torch.cat((trg, pad), dim=-1),
-                            #         score + 1.5)  # TODO wat
-                            # else:
-                            t = (
-                                torch.cat((trg, c[..., -1:]), dim=-1),
-                                score - torch.sum(out.values[:, -1:, i]).item())
-                            new_candidates.append(t)
-                    new_candidates = sorted(new_candidates, key=lambda x: x[1])  # TODO is this sorting right?
-                    new_candidates = new_candidates[:k]
-                    instruments[idx] = new_candidates
-                    idx += 1
-            trg = torch.stack((instruments[0][0][0], instruments[1][0][0], instruments[2][0][0], instruments[3][0][0]))
-            trg_mask = create_trg_mask(trg.cpu().numpy())
+                            new_candidates.append((torch.cat((trg, out.indices[..., i]), dim=-1),
+                                                   score - torch.sum(out.values[..., i]).item(), instrument_cache))
+                    instruments[idx] = sorted(new_candidates, key=lambda x: x[1])[:k]
+            trg = torch.stack([candidates[0][0] for candidates in instruments])
+            trg_mask = create_trg_mask(trg)
             out, _, _, d_mems, d_cmems, _ = self.decoder(trg, trg_mask, None, latent, d_mems, d_cmems)
-            out = torch.max(out, dim=-2).indices
-            out = out.permute(2, 0, 1)
+            out = torch.max(out, dim=-1).indices
             outs.append(out)
         return outs
 
@@ -238,11 +227,7 @@ class Tester:
         return note_manager.reconstruct_music(outs)
 
     def reconstruct(self, batch, note_manager):
-        srcs, trgs, src_masks, trg_masks, _ = batch
-        srcs = torch.LongTensor(srcs.long()).to(config["train"]["device"]).transpose(0, 2)
-        trgs = torch.LongTensor(trgs.long()).to(config["train"]["device"]).transpose(0, 2)
-        src_masks = torch.BoolTensor(src_masks).to(config["train"]["device"]).transpose(0, 2)
-        trg_masks = torch.BoolTensor(trg_masks).to(config["train"]["device"]).transpose(0, 2)
+        srcs, trgs, src_masks, trg_masks, _ = batch  # on device
         e_mems, e_cmems, d_mems, d_cmems = get_memories()
         latent = None
         for src, src_mask in zip(srcs, src_masks):
@@ -297,8 +282,8 @@ if __name__ == "__main__":
     print("tr_loader_length", len(tr_loader))
     print("ts_loader_length", len(ts_loader))
 
-    song1 = tr_loader.__iter__().__next__()
-    song2 = tr_loader.__iter__().__next__()
+    song1 = batch_to_device(tr_loader.__iter__().__next__())
+    song2 = batch_to_device(tr_loader.__iter__().__next__())
 
     # load representation manager
     nm = NoteRepresentationManager()
@@ -0,0 +1,79 @@
+import time
+import pytest
+import torch
+from config import config
+from iterate_dataset import DevicePrefetcher
+from utilities import batch_to_device
+
+
+class SlowLoader:
+    """
+    Gives the batches after a warm-up, as loader workers that start, and then after a delay each
+    """
+
+    def __init__(self, batches, warm_up, delay, pin_memory=False):
+        self.batches = [batch.pin_memory() if pin_memory else batch for batch in batches]
+        self.warm_up = warm_up
+        self.delay = delay
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        time.sleep(self.warm_up)
+        for batch in self.batches:
+            time.sleep(self.delay)
+            yield batch
+
+
+def random_batches(n_batches=6, n_batch=2, n_bars=3, n_tokens=20):
+    """
+    :return: batches of tokens as given by SongIterator, with some padding
+    """
+    batches = torch.randint(config["tokens"]["eos"] + 1, config["tokens"]["vocab_size"],
+                            (n_batches, n_batch, 4, n_bars, n_tokens), dtype=torch.int16)
+    batches[..., -3:] = config["tokens"]["pad"]
+    return list(batches)
+
+
+def check_prefetcher(device, pin_memory, warm_up=0.5, delay=0.01):
+    """
+    The prefetcher gives the batches of the loader on device, as batch_to_device, in order, and its stall does not
+    count the warm-up of the loader
+    """
+    previous = config["train"]["device"]
+    config["train"]["device"] = device
+    try:
+        torch.manual_seed(0)
+        batches = random_batches()
+        prefetcher = DevicePrefetcher(SlowLoader(batches, warm_up, delay, pin_memory), device)
+        assert len(prefetcher) == len(batches)
+        given = 0
+        for batch, expected in zip(prefetcher, batches):
+            assert prefetcher.stall < warm_up / 2, given
+            total = sum(x.float().sum() for x in batch)  # used on the main stream while the next one is copied
+            expected = batch_to_device(expected)
+            assert all(x.device.type == torch.device(device).type for x in batch)
+            assert all(torch.equal(x.cpu(), y.cpu()) for x, y in zip(batch, expected)), given
+            assert total.item() == sum(y.float().sum() for y in expected).item(), given
+            given += 1
+        assert given == len(batches)
+    finally:
+        config["train"]["device"] = previous
+
+
+def test_device_prefetcher():
+    check_prefetcher("cpu", False)
+
+
+def test_device_prefetcher_cuda():
+    if not torch.cuda.is_available():
+        pytest.skip("CUDA is not available")
+    check_prefetcher("cuda", True)
+
+
+if __name__ == "__main__":
+    test_device_prefetcher()
+    if torch.cuda.is_available():
+        test_device_prefetcher_cuda()
+    print("device prefetcher gives the batches on the device")
@@ -0,0 +1,80 @@
+import copy
+import pickle
+import torch
+from config import config
+from compressive_transformer import CompressiveEncoder, CompressiveDecoder, INSTRUMENTS
+from utilities import create_trg_mask
+
+
+def run(model, fused, inputs, **kwargs):
+    """
+    :return: outputs of model with the fused or the looped instruments, and the gradients of a loss on all of them
+    """
+    config["model"]["fused_instruments"] = fused
+    model.zero_grad()
+    outputs = [o for o in model(*inputs, **kwargs) if o is not None]
+    loss = sum(o.float().sin().mean() for o in outputs)
+    loss.backward()
+    return [o.detach() for o in outputs], {n: p.grad.clone() for n, p in model.named_parameters() if p.grad is not None}
+
+
+def assert_close(looped, fused, tolerance, what):
+    (outputs, grads), (fused_outputs, fused_grads) = looped, fused
+    assert len(outputs) == len(fused_outputs), what
+    for a, b in zip(outputs, fused_outputs):
+        assert a.shape == b.shape and (a - b).abs().max() <= tolerance, what
+    assert grads.keys() == fused_grads.keys(), what
+    for name in grads:
+        assert (grads[name] - fused_grads[name]).abs().max() <= tolerance, (what, name)
+
+
+def test_fused_instruments(n_batch=2, width=50, tolerance=1e-5):
+    """
+    The fused forward of encoder and decoder gives the outputs, memories and gradients of the looped one, also after
+    optimizer steps, that change the stacked parameters kept between forwards
+    """
+    model = config["model"]
+    device, fused = config["train"]["device"], model["fused_instruments"]
+    config["train"]["device"] = "cpu"
+    try:
+        torch.manual_seed(0)
+        encoder = CompressiveEncoder(device="cpu").eval()  # no dropout, so that both paths see the same
+        decoder = CompressiveDecoder(device="cpu").eval()
+        with torch.no_grad():  # parameters that are zero at initialization
+            for p in list(encoder.parameters()) + list(decoder.parameters()):
+                if p.dim() == 1 or p is encoder.pos_emb or p is decoder.pos_emb:
+                    p.normal_(0, 0.1)
+        tokens = torch.randint(config["tokens"]["eos"] + 1, config["tokens"]["vocab_size"], (4, n_batch, width))
+        tokens[..., -5:] = config["tokens"]["pad"]
+        shape = (4, model["layers"], n_batch, model["mem_len"], model["d_model"])
+        mems, cmems = torch.randn(shape), torch.randn(shape[:3] + (model["cmem_len"], model["d_model"]))
+        latent = torch.randn(n_batch, model["n_latents"], model["d_model"])
+        encoder_inputs = (tokens, tokens != config["tokens"]["pad"], mems, cmems)
+        decoder_inputs = (tokens, create_trg_mask(tokens), None, latent, mems, cmems)
+        optimizer = torch.optim.Adam(list(encoder.parameters()) + list(decoder.parameters()), lr=1e-2)
+        for step in range(3):
+            assert_close(run(encoder, False, encoder_inputs), run(encoder, True, encoder_inputs), tolerance,
+                         ("encoder", step))
+            assert_close(run(decoder, False, decoder_inputs), run(decoder, True, decoder_inputs), tolerance,
+                         ("decoder", step))
+            optimizer.step()
+        weights = torch.rand(4, n_batch, width, 3).softmax(-1)
+        mixed = torch.randint(0, config["tokens"]["vocab_size"], (4, n_batch, width, 3))
+        mixed_inputs = (mixed,) + decoder_inputs[1:]
+        assert_close(run(decoder, False, mixed_inputs, emb_weights=weights),
+                     run(decoder, True, mixed_inputs, emb_weights=weights), tolerance, "emb_weights")
+        for i, name in enumerate(INSTRUMENTS):
+            just_inputs = (tokens[i], decoder_inputs[1][i]) + decoder_inputs[2:]
+            assert_close(run(decoder, False, just_inputs, just=name), run(decoder, True, just_inputs, just=name),
+                         tolerance, name)
+        # stacked parameters are not saved with the model
+        assert "stacked_parameters" in decoder.__dict__
+        assert "stacked_parameters" not in pickle.loads(pickle.dumps(decoder)).__dict__
+        assert "stacked_parameters" not in copy.deepcopy(encoder).__dict__
+    finally:
+        config["train"]["device"], model["fused_instruments"] = device, fused
+
+
+if __name__ == "__main__":
+    test_fused_instruments()
+    print("fused instruments match the looped ones")
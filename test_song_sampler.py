@@ -0,0 +1,46 @@
+import numpy as np
+from iterate_dataset import SongContiguousBatchSampler
+
+
+def random_windows(rng, n_songs, max_windows):
+    """
+    :return: windows (song id, start bar, length) of songs with a random number of windows, in random order
+    """
+    windows = [(song, start * 4, 4) for song in range(n_songs) for start in range(int(rng.integers(1, max_windows)))]
+    return np.array(windows, dtype=np.int64)[rng.permutation(len(windows))]
+
+
+def test_song_sampler(trials=30, seed=0):
+    """
+    The sampler gives the windows of each song in consecutive batches at the same position, marks the positions that
+    start a song and gives as many batches as its length, also after an epoch left before its end
+    """
+    rng = np.random.default_rng(seed)
+    np.random.seed(seed)
+    for trial in range(trials):
+        windows = random_windows(rng, int(rng.integers(0, 40)), int(rng.integers(2, 12)))
+        indices = rng.permutation(len(windows))[:max(1, len(windows) * 3 // 4)] if len(windows) > 0 else []
+        batch_size = int(rng.integers(1, 6))
+        sampler = SongContiguousBatchSampler(indices, windows, batch_size)
+        for epoch in range(3):
+            length = len(sampler)
+            if epoch == 1:  # left before its end, the next epoch has its own length
+                for _ in zip(range(length // 2), sampler):
+                    pass
+                continue
+            batches = list(sampler)
+            assert len(batches) == length == len(sampler.firsts), (trial, epoch)
+            given = [idx for batch in batches for idx in batch]
+            assert len(given) == len(set(given)) and set(given) <= set(int(i) for i in indices), (trial, epoch)
+            for previous, batch, first in zip([None] + batches, batches, sampler.firsts):
+                for p, idx in enumerate(batch):
+                    if first[p]:
+                        assert previous is None or windows[previous[p], 0] != windows[idx, 0], (trial, epoch)
+                    else:  # next window of the same song
+                        assert previous is not None and windows[previous[p], 0] == windows[idx, 0], (trial, epoch)
+                        assert windows[previous[p], 1] < windows[idx, 1], (trial, epoch)
+
+
+if __name__ == "__main__":
+    test_song_sampler()
+    print("song sampler gives contiguous windows and its length")
@@ -0,0 +1,147 @@
+import io
+import numpy as np
+import muspy
+from config import config
+from utilities import min_max_scaling
+from create_bar_dataset import NoteRepresentationManager
+
+
+class RecordedStats:
+    """
+    Keeps the values given to ConversionStats.add as lists, to compare them with the ones of the loop
+    """
+
+    def __init__(self):
+        self.values = {"bar_length": [], "song_length": []}
+
+    def add(self, name, instrument, values):
+        self.values[name].extend(int(v) for v in np.asarray(values).ravel())
+
+
+def loop_transform_track(self, s):
+    """
+    transform_track as it was before being vectorized, a note at a time, bar and song lengths are returned
+    """
+    bar_lengths, song_lengths = [], []
+    track = np.full((config["data"]["max_bars"], config["data"]["max_bar_length"]), config["tokens"]["pad"],
+                    dtype=np.int16)
+    time_signature = 4  # default time signature, if none starts from 0
+    bar_steps = config["data"]["resolution"] * time_signature
+    use_velocity = config["data"]["use_velocity"]
+    try:
+        notes = s.to_note_representation()
+    except Exception as e:
+        self.log.write(str(self.song_index) + ': ' + e.__str__() + '\n')
+        return None, bar_lengths, song_lengths
+    i = 0  # bar index
+    j = 0  # token index
+    n = 0  # notes index
+    previous_time = -1
+    while n < len(notes):
+        # add empty bar till note time value is in range
+        while notes[n][0] >= bar_steps:
+            if i < config["data"]["max_bars"] - 1:
+                i += 1
+                bar_lengths.append(j)  # empty bar
+                j = 0
+                previous_time = -1
+                notes[n:, 0] -= round(bar_steps)  # decrease all time measures
+            else:
+                # log bars length and return song
+                bars_left = sorted(notes[n:], key=lambda x: x[0])[-1][0] % bar_steps
+                self.log.write(str(self.song_index) + ": Maximum number of bars reached, total was "+str(i+bars_left))
+                song_lengths.append(i + bars_left)
+                return track, bar_lengths, song_lengths  # truncate song: no more space for bars
+        # check note values
+        if not notes[n][0] < config["tokens"]["time_n_values"]:  # check value of time
+            self.log.write(str(self.song_index) + ": Invalid time: " + str(notes[n][0]) + '\n')
+            n += 1
+            continue  # skip note: invalid time
+        if notes[n][0] == previous_time:  # skip note if previous time is the same
+            n += 1
+            continue
+        if not notes[n][1] < config["tokens"]["pitch_n_values"]:  # check value of pitch
+            self.log.write(str(self.song_index) + ": Invalid pitch: " + str(notes[n][1]))
+            n += 1
+            continue  # skip note: invalid pitch
+        if not notes[n][2] < config["tokens"]["duration_n_values"]:  # clip duration if > 127
+            notes[n][2] = config["tokens"]["duration_n_values"] - 1
+        if use_velocity:  # if velocity, use min-max normalization with new interval
+            notes[n][3] = min_max_scaling(notes[n][3], config["data"]["velocities_total"],
+                                          config["data"]["velocities_compact"])  # no need to check values
+        # add note
+        if j + (4 if use_velocity else 3) < config["data"]["max_bar_length"] - 1:  # if enough space for note
+            track[i][j] = notes[n][0] + self.offsets[0]
+            track[i][j + 1] = notes[n][1] + self.offsets[1]
+            track[i][j + 2] = notes[n][2] + self.offsets[2]
+            if use_velocity:
+                track[i][j + 3] = notes[n][3] + self.offsets[3]
+            j += (4 if use_velocity else 3)
+            previous_time = notes[n][0]
+            n += 1
+        else:
+            # no more space inside the bar, count tokens left and skip bar notes
+            notes_left = (notes[n:, 0] < bar_steps).sum()
+            tok_left = notes_left * (4 if use_velocity else 3)
+            self.log.write(str(self.song_index) + ": Reached max bar length, left tokens: " + str(j + tok_left) + "\n")
+            bar_lengths.append(j + tok_left)
+            n += notes_left
+    song_lengths.append(i)
+    return track, bar_lengths, song_lengths
+
+
+def random_track(rng, n_notes, max_time, max_pitch=128, chords=False):
+    """
+    :param chords: add notes with the same time, that are skipped
+    :return: song with a single track of random notes
+    """
+    song = muspy.Music(resolution=config["data"]["resolution"])
+    track = muspy.Track()
+    times = rng.integers(0, max_time, n_notes)
+    if chords:
+        times = np.concatenate([times, np.repeat(rng.integers(0, max_time, 5), 40)])
+    for time in times:
+        track.notes.append(muspy.Note(int(time), int(rng.integers(0, max_pitch)), int(rng.integers(0, 300)),
+                                      int(rng.integers(0, 128))))
+    song.tracks.append(track)
+    return song
+
+
+def test_transform_track(trials=100, seed=0):
+    """
+    transform_track gives the same tensors, bar lengths, song lengths and logs of the loop on random tracks with
+    invalid times and pitches, bars that overflow and songs longer than max_bars
+    """
+    rng = np.random.default_rng(seed)
+    data = dict(config["data"])
+    # resolution, max_bars, max_bar_length, use_velocity
+    settings = [(24, 200, 200, False), (24, 5, 200, True), (40, 7, 30, False), (24, 6, 20, True), (40, 3, 200, True),
+                (12, 50, 13, False)]
+    try:
+        for resolution, max_bars, max_bar_length, use_velocity in settings:
+            config["data"].update(resolution=resolution, max_bars=max_bars, max_bar_length=max_bar_length,
+                                  use_velocity=use_velocity)
+            manager = NoteRepresentationManager()
+            manager.song_index = 7
+            for trial in range(trials):
+                song = random_track(rng, int(rng.integers(0, 400)), int(rng.integers(1, 4000)),
+                                    max_pitch=int(rng.choice([128, 140])), chords=trial % 3 == 0)
+                manager.log, manager.stats = io.StringIO(), RecordedStats()
+                track = manager.transform_track(song)
+                log, stats = manager.log.getvalue(), manager.stats.values
+                manager.log = io.StringIO()
+                expected, bar_lengths, song_lengths = loop_transform_track(manager, song)
+                setting = (resolution, max_bars, max_bar_length, use_velocity, trial)
+                assert (track is None) == (expected is None), setting
+                assert track is None or np.array_equal(track, expected), setting
+                assert stats["bar_length"] == bar_lengths, setting
+                assert stats["song_length"] == song_lengths, setting
+                assert log == manager.log.getvalue(), setting
+    finally:
+        config["data"].clear()
+        config["data"].update(data)
+
+
+if __name__ == "__main__":
+    test_transform_track()
+    print("transform_track matches the loop")
@@ -3,7 +3,7 @@ import torch
 from datetime import datetime
 from tqdm.auto import tqdm
 from config import config, remote
-from iterate_dataset import SongIterator
+from iterate_dataset import SongIterator, DevicePrefetcher, SongContiguousBatchSampler
 from optimizer import CTOpt
 from loss_computer import SimpleLossCompute, compute_accuracy, LabelSmoothing
 from create_bar_dataset import NoteRepresentationManager  # TODO check
@@ -34,6 +34,7 @@ class Trainer:
         self.step = 0
         self.loss_computer = None
         self.tf_prob = 0
+        self.memories = {"train": None, "eval": None}  # memories carried to the next window of each song
         # Models
         self.encoder = None
         self.latent_compressor = None
@@ -75,14 +76,43 @@ class Trainer:
                 if parameter.grad is None:
                     print(module_name)
 
-    def run_mb(self, batch):
+    def carried_memories(self, first, n_batch):
+        """
+        Memories left by the last window of each song of the batch, detached so that gradients stop at the window.
+        Encoder and decoder keep a memory for each song of the batch
+        :param first: boolean tensor with the songs of the batch that start with this window, None to start all
+        :param n_batch: songs in the batch
+        :return: e_mems, e_cmems, d_mems, d_cmems
+        """
+        e_mems, e_cmems, d_mems, d_cmems = get_memories(n_batch=n_batch)
+        mode = "train" if self.encoder.training else "eval"
+        if first is None or self.memories[mode] is None:
+            return e_mems, e_cmems, d_mems, d_cmems
+        carried = []
+        for new, old in zip((e_mems, e_cmems, d_mems, d_cmems), self.memories[mode]):
+            if new.shape != old.shape:  # batch size changed
+                carried.append(new)
+                continue
+            carried.append(old * ~first.to(old.device)[None, None, :, None, None])
+        return tuple(carried)
+
+    @staticmethod
+    def firsts(loader):
+        """
+        :return: songs of the next batch of loader that start with it, None if windows are not given in order
+        """
+        if isinstance(loader.batch_sampler, SongContiguousBatchSampler):
+            return loader.batch_sampler.firsts.popleft()
+        return None
+
+    def run_mb(self, batch, first=None):
+        """
+        :param batch: batch on device, as given by DevicePrefetcher
+        :param first: boolean tensor with the songs of the batch that start with this window, the others continue
+        from the memories of the last batch. None to start all of them from empty memories
+        """
         # SETUP VARIABLES
-        srcs, trgs, src_masks, trg_masks, trg_ys = batch
-        srcs = torch.LongTensor(srcs.long()).to(config["train"]["device"]).transpose(0, 2)
-        trgs = torch.LongTensor(trgs.long()).to(config["train"]["device"]).transpose(0, 2)  # invert batch and bars
-        src_masks = torch.BoolTensor(src_masks).to(config["train"]["device"]).transpose(0, 2)
-        trg_masks = torch.BoolTensor(trg_masks).to(config["train"]["device"]).transpose(0, 2)
-        trg_ys = torch.LongTensor(trg_ys.long()).to(config["train"]["device"]).transpose(0, 2)
+        srcs, trgs, src_masks, trg_masks, trg_ys = batch  # on device, with batch and bars inverted
         e_attn_losses = []
         d_attn_losses = []
         outs = []
@@ -90,7 +120,7 @@ class Trainer:
         dec_self_weights = []
         dec_src_weights = []
         latent = None
-        e_mems, e_cmems, d_mems, d_cmems = get_memories()
+        e_mems, e_cmems, d_mems, d_cmems = self.carried_memories(first, srcs.shape[2])
 
         # Encode
         for src, src_mask in zip(srcs, src_masks):
@@ -173,31 +203,39 @@ class Trainer:
         # TODO ##################################
         # TODO GREEDY DECODING
         # TODO ##################################
-        _, _, d_mems, d_cmems = get_memories(n_batch=1)
         outs = []
         self.tf_prob = max(config["train"]["min_tf_prob"],
                            config["train"]["max_tf_prob"] - self.step * config["train"]["tf_prob_step_reduction"])
         for i in range(len(srcs)):
-            trg = np.full((4, 1, 1), config["tokens"]["sos"])
+            trg = np.full((4, trgs.shape[2], 1), config["tokens"]["sos"])  # each song of the batch
             trg = torch.LongTensor(trg).to(config["train"]["device"])
-            for j in range(config["model"]["seq_len"] - 1):  # for each token of each bar
-                if random.random() < self.tf_prob:
-                    trg = torch.cat((trg, trgs[i, :, :, j+1:j+2]), dim=-1)  # teacher forcing, add element j+1
-                else:
-                    trg_mask = create_trg_mask(trg.cpu().numpy())
-                    out, _, _, _, _, _ = self.decoder(trg, trg_mask, None, latent, d_mems, d_cmems)
-                    out = torch.max(out, dim=-1).indices
-                    trg = torch.cat((trg, out[..., -1:]), dim=-1)
-            trg_mask = create_trg_mask(trg.cpu().numpy())
+            with torch.no_grad():  # predictions are only used as next tokens
+                cache = self.decoder.cache(latent, d_mems, d_cmems) if config["train"]["step_decoding"] else None
+                decoded = 0  # tokens of trg already in cache, teacher forced ones are decoded when needed
+                for j in range(trgs.shape[-1] - 1):  # for each token of each bar, bars are padded to the longest one
+                    if random.random() < self.tf_prob:
+                        trg = torch.cat((trg, trgs[i, :, :, j+1:j+2]), dim=-1)  # teacher forcing, add element j+1
+                    else:
+                        if config["train"]["step_decoding"]:
+                            out, cache = self.decoder.step(trg[..., decoded:], cache, length=trgs.shape[-1])
+                            decoded = trg.shape[-1]
+                        else:  # whole prefix again
+                            out, _, _, _, _, _ = self.decoder(trg, create_trg_mask(trg), None, latent, d_mems, d_cmems)
+                        out = torch.max(out, dim=-1).indices
+                        trg = torch.cat((trg, out[..., -1:]), dim=-1)
+            trg_mask = create_trg_mask(trg)
             out, self_weight, src_weight, d_mems, d_cmems, d_attn_loss = self.decoder(trg, trg_mask, None,
                                                                                       latent, d_mems, d_cmems)
-            dec_self_weights.append(self_weight.detach())
-            dec_src_weights.append(src_weight.detach())
+            dec_self_weights.append(self_weight.detach() if self_weight is not None else None)
+            dec_src_weights.append(src_weight.detach() if src_weight is not None else None)
             d_attn_losses.append(d_attn_loss.detach())
             outs.append(out)
         # TODO ##################################
         # TODO END GREEDY DECODING
         # TODO ##################################
+        if first is not None:  # the next window of each song continues from here
+            self.memories["train" if self.encoder.training else "eval"] = tuple(
+                m.detach() for m in (e_mems, e_cmems, d_mems, d_cmems))
         outs = torch.stack(outs, dim=0)
         e_attn_losses = torch.stack(e_attn_losses).mean()
         d_attn_losses = torch.stack(d_attn_losses).mean()
@@ -215,10 +253,11 @@ class Trainer:
             if self.step % config["train"]["after_steps_log_images"] == 0:
                 print("Logging images...")
                 self.logger.log_latent(self.latent)
-                enc_self_weights = torch.stack(enc_self_weights)
-                dec_self_weights = torch.stack(dec_self_weights)
-                dec_src_weights = torch.stack(dec_src_weights)
-                self.logger.log_attn_heatmap(enc_self_weights, dec_self_weights, dec_src_weights)
+                if enc_self_weights[0] is not None:  # the memory efficient attention does not give weights
+                    enc_self_weights = torch.stack(enc_self_weights)
+                    dec_self_weights = torch.stack(dec_self_weights)
+                    dec_src_weights = torch.stack(dec_src_weights)
+                    self.logger.log_attn_heatmap(enc_self_weights, dec_self_weights, dec_src_weights)
                 self.logger.log_memories(e_mems, e_cmems, d_mems, d_cmems)
                 self.logger.log_examples(srcs, trgs, outs, trg_ys)
             if self.step == 0 and config["train"]["test_losses"]:
@@ -370,6 +409,8 @@ class Trainer:
                                batch_size=config["train"]["batch_size"],
                                n_workers=config["train"]["n_workers"])
         tr_loader, ts_loader = dataset.get_loaders()
+        tr_batches = DevicePrefetcher(tr_loader, config["train"]["device"])
+        ts_batches = DevicePrefetcher(ts_loader, config["train"]["device"])
 
         # Wandb
         self.logger = Logger()
@@ -391,7 +432,7 @@ class Trainer:
             assert given <= max_range, "Given {} as input to model with max range {}".format(given, max_range)
             print("Giving ", given, " as input to model with a maximum range of ", max_range)
             print("Giving ", len(tr_loader), " training samples and ", len(ts_loader), " test samples")
-            print("Giving ", config["data"]["truncated_bars"], " bars to a model with ",
+            print("Giving ", config["train"]["n_bars"], " bars to a model with ",
                   config["model"]["layers"], " layers")
             print("Latent size:", config["model"]["n_latents"] * config["model"]["d_model"])
             if config["train"]["aae"]:
@@ -426,14 +467,14 @@ class Trainer:
         first_batch = None  # TODO remove
         # main loop
         for self.epoch in range(config["train"]["n_epochs"]):  # for each epoch
-            for song_it, batch in enumerate(tr_loader):  # for each song
+            for song_it, batch in enumerate(tr_batches):  # for each song
 
                 #########
                 # TRAIN #
                 #########
                 if first_batch is None:  # TODO remove
                     first_batch = batch  # TODO remove
-                tr_losses = self.run_mb(batch)
+                tr_losses = self.run_mb(batch, self.firsts(tr_loader))
 
                 self.logger.log_losses(tr_losses, self.encoder.training)
                 self.logger.log_stuff(self.encoder_optimizer.lr,
@@ -443,6 +484,7 @@ class Trainer:
                                       self.beta if config["train"]["aae"] else None,
                                       get_prior(self.latent.shape) if config["train"]["aae"] else None,
                                       self.tf_prob)
+                self.logger.log_loader(tr_batches.stall, dataset.cache.stats() if dataset.cache is not None else None)
                 train_progress.update()
 
                 ########
@@ -463,11 +505,11 @@ class Trainer:
 
                     # Compute validation score
                     # first = None  TODO put it back
-                    for test in tqdm(ts_loader, position=0, leave=True, desc=desc):  # remember test losses
+                    for test in tqdm(ts_batches, position=0, leave=True, desc=desc):  # remember test losses
                         # if first is None:  TODO put it back
                         #     first = test  TODO put it back
                         with torch.no_grad():
-                            ts_loss = self.run_mb(test)
+                            ts_loss = self.run_mb(test, self.firsts(ts_loader))
                         ts_losses.append(ts_loss)
                     final = ()  # average losses
                     for i in range(len(ts_losses[0])):  # for each loss value
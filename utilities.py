@@ -33,16 +33,34 @@ def get_memories(n_batch=None):
 
 
 def create_trg_mask(trg):
-    trg_mask = np.full(trg.shape + (trg.shape[-1],), True)
-    for i in range(trg.shape[0]):
-        for b in range(trg.shape[1]):
-            line_mask = trg[i][b] != config["tokens"]["pad"]
-            pad_mask = np.matmul(line_mask[:, np.newaxis], line_mask[np.newaxis, :])
-            subsequent_mask = np.expand_dims(np.tril(np.ones((trg.shape[-1], trg.shape[-1]))), (0, 1))
-            subsequent_mask = subsequent_mask.astype(np.bool)
-            trg_mask[i][b] = pad_mask & subsequent_mask
-    trg_mask = torch.BoolTensor(trg_mask).to(config["train"]["device"])
-    return trg_mask
+    """
+    Pad and causal mask of each bar, built on the device of the training
+    :param trg: array or tensor of tokens with shape (..., tokens)
+    :return: boolean tensor with shape (..., tokens, tokens)
+    """
+    trg = torch.as_tensor(trg, device=config["train"]["device"])
+    line_mask = trg != config["tokens"]["pad"]
+    subsequent_mask = torch.ones(trg.shape[-1], trg.shape[-1], dtype=torch.bool, device=trg.device).tril()
+    return line_mask[..., :, None] & line_mask[..., None, :] & subsequent_mask
+
+
+def batch_to_device(batch, non_blocking=False):
+    """
+    Moves a batch of SongIterator to the device with batch and bars swapped. If the loader gave just the tokens,
+    trg is src shifted right after sos and masks are built on the device
+    :param batch: tensor of tokens or tuple (src, trg, src_mask, trg_mask, trg_y)
+    :param non_blocking: copy asynchronously, if the batch is in pinned memory
+    :return: srcs, trgs, src_masks, trg_masks, trg_ys
+    """
+    device = config["train"]["device"]
+    if torch.is_tensor(batch):
+        srcs = batch.to(device, non_blocking=non_blocking).long().transpose(0, 2)
+        sos = torch.full_like(srcs[..., :1], config["tokens"]["sos"])
+        trgs = torch.cat((sos, srcs[..., :-1]), dim=-1)
+        return srcs, trgs, srcs != config["tokens"]["pad"], create_trg_mask(trgs), srcs
+    srcs, trgs, src_masks, trg_masks, trg_ys = [x.to(device, non_blocking=non_blocking) for x in batch]
+    return (srcs.long().transpose(0, 2), trgs.long().transpose(0, 2), src_masks.transpose(0, 2),
+            trg_masks.transpose(0, 2), trg_ys.long().transpose(0, 2))
 
 
 def pad_attention(attentions):  # pad list of array to be the same size